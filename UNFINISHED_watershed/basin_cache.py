@@ -0,0 +1,102 @@
+"""
+On-disk cache of the stages of baseseg that do not depend on the merge parameters.
+
+Steepest ascent, plateau division, basin finding and the region graph only depend on the affinities and on the
+absolute `low` and `high` thresholds. BasinCache stores their results (`seg`, `counts` and `rg`) in a directory, one
+.npz file per key, where the key hashes the content of the affinities together with `low` and `high`. Rerunning with
+other merge_threshold, merge_size or dust_size then only reruns mergeregions.
+
+The cache holds at most `max_bytes`; storing a new entry evicts the least recently used ones beyond that.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy
+from graph_functions import RegionGraph
+
+CACHE_VERSION = 1 #Part of every key, bump when the stored format or the cached stages change
+DEFAULT_CACHE_BYTES = 10 * 2**30
+HASH_CHUNK_BYTES = 64 * 2**20 #Affinities are hashed this many bytes at a time
+
+def affinity_digest(aff, chunk_bytes=HASH_CHUNK_BYTES):
+    """Content hash of an affinity array or memmap, including its shape and dtype, read in slabs along the first axis"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str((aff.shape, aff.dtype.str)).encode())
+    if aff.size == 0:
+        return digest.hexdigest()
+    step = max(chunk_bytes // max(aff[0].nbytes, 1), 1)
+    for start in range(0, aff.shape[0], step):
+        digest.update(numpy.ascontiguousarray(aff[start:start+step]).data)
+    return digest.hexdigest()
+
+class BasinCache(object):
+    """Directory of cached (seg, counts, rg) triples, see the module documentation"""
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, aff, low, high):
+        """Key of the basins of aff at absolute thresholds low and high"""
+        return hashlib.blake2b(str((CACHE_VERSION, affinity_digest(aff), float(low), float(high))).encode(),
+                               digest_size=20).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """(seg, counts, rg) stored under key, or None if there is no such entry"""
+        path = self._path(key)
+        try:
+            with numpy.load(path) as entry:
+                result = (entry['seg'], entry['counts'], RegionGraph(entry['weights'], entry['ids']))
+        except (IOError, OSError, KeyError, ValueError): #Missing, or evicted or damaged while we read it
+            return None
+        os.utime(path, None) #Mark as recently used
+        return result
+
+    def store(self, key, seg, counts, rg):
+        """Store (seg, counts, rg) under key, then evict the least recently used entries beyond max_bytes"""
+        (handle, temporary) = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as entry:
+                numpy.savez(entry, seg=seg, counts=counts, weights=rg.weights, ids=rg.ids)
+            os.replace(temporary, self._path(key)) #Readers never see a partly written entry
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def entries(self):
+        """(last use, bytes, path) of every entry, least recently used first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache holds at most max_bytes"""
+        entries = self.entries()
+        total = sum(size for (used, size, path) in entries)
+        for (used, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry"""
+        for (used, size, path) in self.entries():
+            os.remove(path)
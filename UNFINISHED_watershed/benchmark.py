@@ -0,0 +1,231 @@
+"""
+Benchmark of the stages of the watershed pipeline (baseseg and mst) on synthetic affinity volumes.
+
+For every volume size, synthetic affinities are generated with a fixed seed and each stage is timed on its own:
+steepestascent, divideplateaus, findbasins, regiongraph, mergeregions and mst. For each stage we report the wall time,
+the CPU time, the throughput in voxels per second and the peak resident memory of the process while the stage ran. Results are
+written as JSON so that two runs can be compared, and the scaling exponent between consecutive sizes
+(1.0 = linear in the number of voxels) shows which stage stops scaling first.
+
+With --check_backends, the stages are instead run on every available backend of graph_functions (numpy, numba) and
+their outputs are compared; the exit status is 1 if any differ.
+
+Example:
+    python benchmark.py --sizes 64 128 256 --output bench.json --compare old_bench.json --plot scaling.png
+    python benchmark.py --sizes 32 64 --check_backends
+"""
+
+import os
+import io
+import json
+import time
+import argparse
+import platform
+import sys
+import contextlib
+import numpy
+from graph_functions import *
+from instrumentation import measure
+
+DEFAULT_SIZES = [64, 128, 192]
+DEFAULT_SEED = 0
+DEFAULT_CELL_SIZE = 12 #Average edge length of the synthetic cells, in voxels
+LOW = 0.1
+HIGH = 0.8
+THRESHOLDS = [(800, 0.2)]
+DUST_SIZE = 600
+STAGES = ['steepestascent', 'divideplateaus', 'findbasins', 'regiongraph', 'mergeregions', 'mst']
+
+def synthetic_affinities(shape, seed=DEFAULT_SEED, cell_size=DEFAULT_CELL_SIZE):
+    """
+    Affinities of a volume cut into random box-shaped cells: high inside cells, low across their boundaries, with
+    uniform noise on top. The same shape and seed always give the same volume.
+    """
+    rng = numpy.random.default_rng(seed)
+    labels = numpy.zeros(shape, dtype='uint32')
+    for axis in range(3):
+        # random cut positions along each axis, combined into one cell ID per voxel
+        cuts = numpy.cumsum(rng.random(shape[axis]) < 1.0/cell_size)
+        index = [numpy.newaxis] * 3
+        index[axis] = slice(None)
+        labels = labels * (shape[axis] + 1) + cuts[tuple(index)].astype('uint32')
+    aff = numpy.empty(tuple(shape) + (3,), dtype='float32')
+    for axis in range(3):
+        same = numpy.zeros(shape, dtype=bool)
+        here = [slice(None)] * 3
+        there = [slice(None)] * 3
+        here[axis] = slice(1, None)
+        there[axis] = slice(None, -1)
+        same[tuple(here)] = labels[tuple(here)] == labels[tuple(there)]
+        aff[..., axis] = numpy.where(same, 0.7, 0.05) + 0.3 * rng.random(shape, dtype='float32')
+    return aff
+
+def _timed(stage, voxels, results, function, *args):
+    """Run function(*args) quietly and keep its stage record from instrumentation.measure under `stage`"""
+    with measure(stage, voxels, lambda record: results.__setitem__(stage, record)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args)
+
+def run_pipeline(aff):
+    """Time every stage of baseseg followed by mst on one affinity volume, returns {stage: measurements}"""
+    voxels = aff.size // 3
+    results = {}
+    sag = _timed('steepestascent', voxels, results, steepestascent, aff, LOW, HIGH)
+    sag = _timed('divideplateaus', voxels, results, divideplateaus, sag)
+    (seg, counts, counts0) = _timed('findbasins', voxels, results, findbasins, sag)
+    del sag
+    rg = _timed('regiongraph', voxels, results, regiongraph, aff, seg, len(counts))
+    (new_rg, counts) = _timed('mergeregions', voxels, results, mergeregions, seg, rg, counts, THRESHOLDS, DUST_SIZE)
+    _timed('mst', voxels, results, mst, new_rg, len(counts))
+    return results
+
+def _outputs(aff, low, high):
+    """Output of every backend-dependent stage on aff, by stage"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        sag = steepestascent(aff, low, high)
+        outputs = {'steepestascent': sag.copy()}
+        sag = divideplateaus(sag)
+        outputs['divideplateaus'] = sag.copy()
+        (seg, counts, counts0) = findbasins(sag)
+        outputs['findbasins'] = (seg, counts, counts0)
+        outputs['regiongraph'] = regiongraph(aff, seg, len(counts))
+    return outputs
+
+def _same(a, b):
+    if isinstance(a, RegionGraph):
+        return numpy.array_equal(a.weights, b.weights) and numpy.array_equal(a.ids, b.ids)
+    if isinstance(a, tuple):
+        return all(_same(x, y) for (x, y) in zip(a, b))
+    return numpy.array_equal(a, b)
+
+def check_backends(sizes, seed):
+    """
+    Run steepestascent, divideplateaus, findbasins and regiongraph on every available backend, for synthetic volumes
+    of every size, as float32 and quantized to uint8, with ordinary and with inverted (low >= high) thresholds.
+    Prints a line per mismatch and returns whether all backends agree
+    """
+    backends = [name for name in BACKENDS if name == 'numpy' or numba_kernels is not None]
+    if len(backends) < 2:
+        print("Only the numpy backend is available, nothing to compare")
+        return True
+    previous = get_backend()
+    agree = True
+    for size in sizes:
+        aff = synthetic_affinities((size, size, size), seed)
+        quantized = numpy.rint(numpy.clip(aff, 0.0, 1.0) / affinity_scale('uint8')).astype('uint8')
+        for (volume, low, high) in [(aff, LOW, HIGH), (quantized, LOW, HIGH), (aff, HIGH, LOW)]:
+            results = []
+            for name in backends:
+                set_backend(name)
+                results.append(_outputs(volume, low, high))
+            for (name, outputs) in zip(backends[1:], results[1:]):
+                for stage in outputs:
+                    if not _same(results[0][stage], outputs[stage]):
+                        agree = False
+                        print("%s differs between %s and %s for size %d, %s, low %g, high %g"
+                              % (stage, backends[0], name, size, volume.dtype, low, high))
+    set_backend(previous)
+    print("Backends " + ("agree" if agree else "differ") + ": " + ", ".join(backends))
+    return agree
+
+def scaling_exponents(runs):
+    """
+    Add to every run but the first a `scaling_exponent` per stage: log(time ratio) / log(voxel ratio) against the
+    previous size. 1.0 means the stage scales linearly with the number of voxels.
+    """
+    for (previous, run) in zip(runs, runs[1:]):
+        ratio = numpy.log(float(run['voxels']) / previous['voxels'])
+        for stage in STAGES:
+            (before, after) = (previous['stages'][stage]['wall_seconds'], run['stages'][stage]['wall_seconds'])
+            exponent = numpy.log(after / before) / ratio if before > 0 and after > 0 and ratio > 0 else None
+            run['stages'][stage]['scaling_exponent'] = exponent
+    return runs
+
+def print_report(runs, baseline=None):
+    """Print a table of voxels/s, peak memory and scaling per stage and size, with speedups against a baseline run"""
+    old = {}
+    if baseline is not None:
+        old = dict((tuple(run['shape']), run['stages']) for run in baseline['runs'])
+    print("%-16s %-16s %14s %12s %10s %10s" % ('stage', 'shape', 'voxels/s', 'peak MB', 'scaling', 'speedup'))
+    for stage in STAGES:
+        for run in runs:
+            measured = run['stages'][stage]
+            exponent = measured.get('scaling_exponent')
+            speedup = ''
+            if stage in old.get(tuple(run['shape']), {}):
+                speedup = '%.2fx' % (old[tuple(run['shape'])][stage]['wall_seconds'] / measured['wall_seconds'])
+            print("%-16s %-16s %14.3g %12.1f %10s %10s" % (stage, 'x'.join(str(s) for s in run['shape']),
+                  measured['voxels_per_second'], measured['peak_rss_mb'],
+                  '' if exponent is None else '%.2f' % exponent, speedup))
+
+def plot_scaling(runs, path):
+    """Save log-log curves of seconds against voxels for every stage"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    voxels = [run['voxels'] for run in runs]
+    for stage in STAGES:
+        plt.loglog(voxels, [run['stages'][stage]['wall_seconds'] for run in runs], marker='o', label=stage)
+    plt.loglog(voxels, [runs[0]['stages'][STAGES[0]]['wall_seconds'] * v / voxels[0] for v in voxels], 'k:', label='linear')
+    plt.xlabel('voxels')
+    plt.ylabel('seconds')
+    plt.legend()
+    plt.savefig(path)
+
+def main(sizes, seed, output, compare, plot, backend=None, check=False):
+    if check:
+        return check_backends(sizes, seed)
+    if backend is not None:
+        set_backend(backend)
+    if get_backend() != 'numpy':
+        run_pipeline(synthetic_affinities((16, 16, 16), seed)) #Compile the kernels outside of the timings
+    runs = []
+    for size in sizes:
+        shape = tuple(size) if isinstance(size, (list, tuple)) else (size, size, size)
+        print("Benchmarking " + 'x'.join(str(s) for s in shape) + "...")
+        aff = synthetic_affinities(shape, seed)
+        runs.append({'shape': list(shape), 'voxels': int(numpy.prod(shape)), 'stages': run_pipeline(aff)})
+        del aff
+    scaling_exponents(runs)
+    results = {'seed': seed,
+               'backend': get_backend(),
+               'numpy': numpy.__version__,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'cpus': os.cpu_count(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'runs': runs}
+    baseline = None
+    if compare is not None:
+        with open(compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(runs, baseline)
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print("Results written to " + output)
+    if plot is not None:
+        plot_scaling(runs, plot)
+        print("Scaling curves written to " + plot)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', dest='sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help='Edge lengths of the cubic synthetic volumes, smallest first')
+    parser.add_argument('--seed', dest='seed', type=int, default=DEFAULT_SEED,
+        help='Seed of the synthetic affinities')
+    parser.add_argument('--output', dest='output', type=str, default=None,
+        help='JSON file to write the results to')
+    parser.add_argument('--compare', dest='compare', type=str, default=None,
+        help='JSON results of an earlier run to report speedups against')
+    parser.add_argument('--plot', dest='plot', type=str, default=None,
+        help='Image file to save the scaling curves to')
+    parser.add_argument('--backend', dest='backend', type=str, default=None, choices=BACKENDS,
+        help='Backend of the core kernels, by default the WATERSHED_BACKEND environment variable or numba if installed')
+    parser.add_argument('--check_backends', dest='check', action='store_true',
+        help='Compare the outputs of all available backends instead of timing the stages')
+    args = parser.parse_args()
+    results = main(**vars(args))
+    if args.check and not results:
+        sys.exit(1)
@@ -9,8 +9,23 @@ import cv2
 import h5py
 from PIL import Image, ImageSequence
 import matplotlib.pyplot as plt
+import glob
+import queue
 import random
-from skimage.filters import scharr
+import tempfile
+import threading
+import concurrent.futures
+from scipy import ndimage
+from skimage.util import img_as_float
+
+BOUNDARY_THRESHOLD = 0.0000001 #Scharr magnitude above which a pixel lies on a boundary between labels
+# Offsets (dz, dy, dx) of the ground truth affinities of the ISBI training data
+AFFINITY_OFFSETS = [(0,0,1), (0,1,0), (1,0,0),
+                    (0,0,3), (0,3,0), (2,0,0),
+                    (0,0,9), (0,9,0), (3,0,0),
+                    (0,0,27), (0,27,0), (4,0,0)]
+# The 2D Scharr kernels of skimage.filters.scharr, as (1, 3, 3) kernels that filter every slice of a stack on its own
+SCHARR_KERNELS = [np.outer([1, 0, -1], [3, 10, 3])[np.newaxis] / 16.0, np.outer([3, 10, 3], [1, 0, -1])[np.newaxis] / 16.0]
 
 def check_volume(data):
     """Ensure that data is numpy 3D array."""
@@ -72,32 +87,117 @@ def affinitize(img, dst, dtype='float32'):
 
     return np.squeeze(ret)
 
-def create_boundary_map(np_volume, np_masks, plot=False):
-    adjusted_masks = []
-    for i in range(np.shape(np_masks)[0]):
-        mask = np.squeeze(np_masks[i,:,:])
-        adjusted_mask = scharr(mask)
-        adjusted_mask[adjusted_mask > 0.0000001] = 255
-        adjusted_mask[adjusted_mask <= 0.0000001] = 0
-        adjusted_mask = adjusted_mask.astype(np.uint8)
-        idx = np.where((mask ==0 ))
-        adjusted_mask[idx] = 255
-        kernel = np.ones((3,3),np.uint8)
-        adjusted_mask = cv2.dilate(adjusted_mask,kernel,iterations = 1)
-        adjusted_mask = np.invert(adjusted_mask)
-        adjusted_masks.append(adjusted_mask)
-        if plot:
-            f, (ax1,ax2,ax3) = plt.subplots(1,3)
-            ax1.imshow(np.squeeze(np_volume[i,:,:]), cmap='gray')
-            ax1.set_title('image')
-            ax2.imshow(mask)
-            ax2.set_title('labels')
-            ax3.imshow(adjusted_mask, cmap='gray')
-            ax3.set_title('binary mask')
-            plt.show()
+def _offset_slices(n, d, start=0, stop=None):
+    """
+    Slices (here, there) along an axis of length n such that voxel here[i] pairs with voxel there[i] = here[i] - d,
+    with here restricted to [start, stop).
+    """
+    stop = n if stop is None else stop
+    lo = max(start, d, 0)
+    hi = max(min(stop, n + min(d, 0)), lo)
+    return slice(lo, hi), slice(lo - d, hi - d)
 
-    adjusted_masks = np.array(adjusted_masks)
-    return adjusted_mask
+def affinitize_many(img, offsets, dtype=bool, packbits=False, slab_size=None, out=None):
+    """
+    Affinity graphs of a segmentation for several offsets at once, into one preallocated stack.
+    Args:
+        img: 3D indexed image (z, y, x), with each index corresponding to each segment. May be a memmap or an
+            HDF5 dataset, which is then read one z-slab at a time.
+        offsets: sequence of (dz, dy, dx). Channel i is 1 where a voxel and the voxel `offsets[i]` before it have the
+            same nonzero index, as affinitize(img, offsets[i]) gives for offsets along a single axis.
+        dtype: bool or uint8.
+        packbits: pack the x axis into bits with np.packbits, 8x smaller; np.unpackbits(ret, axis=-1,
+            count=img.shape[-1]) restores it.
+        slab_size: compute this many z-planes at a time, so that only a slab of img and of the result are in memory
+            besides `out`. The whole volume at once when None.
+        out: array (or memmap, or HDF5 dataset) to write the result into instead of allocating it.
+    Returns:
+        ret: (len(offsets), z, y, x) affinities, or (len(offsets), z, y, ceil(x / 8)) uint8 with packbits
+    """
+    if isinstance(img, np.ndarray):
+        img = check_volume(img)
+    assert len(img.shape) == 3
+    (zdim, ydim, xdim) = img.shape
+    for offset in offsets:
+        assert all(abs(d) < n for (d, n) in zip(offset, img.shape))
+    shape = (len(offsets), zdim, ydim, (xdim + 7) // 8 if packbits else xdim)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8 if packbits else dtype)
+    assert tuple(out.shape) == shape
+
+    slab_size = zdim if slab_size is None else slab_size
+    reach = [max(max(offset[0] for offset in offsets), 0), max(-min(offset[0] for offset in offsets), 0)]
+    for z0 in range(0, zdim, slab_size):
+        z1 = min(z0 + slab_size, zdim)
+        # the slab plus the planes its offsets reach into, relative to which all slices below are taken
+        (lo, hi) = (max(z0 - reach[0], 0), min(z1 + reach[1], zdim))
+        labels = np.asarray(img[lo:hi])
+        slab = np.zeros((len(offsets), z1 - z0, ydim, xdim), dtype=dtype)
+        for (i, (dz, dy, dx)) in enumerate(offsets):
+            (here_z, there_z) = _offset_slices(hi - lo, dz, z0 - lo, z1 - lo)
+            (here_y, there_y) = _offset_slices(ydim, dy)
+            (here_x, there_x) = _offset_slices(xdim, dx)
+            here = labels[here_z, here_y, here_x]
+            there = labels[there_z, there_y, there_x]
+            target = slab[i, here_z.start-(z0-lo):here_z.stop-(z0-lo), here_y, here_x]
+            np.logical_and(here == there, here > 0, out=target, casting='unsafe')
+        out[:, z0:z1] = np.packbits(slab, axis=-1) if packbits else slab
+    return out
+
+def _boundary_slices(np_masks, out, start, stop):
+    """Boundary maps of the slices start to stop of np_masks, written into the same slices of out"""
+    masks = np.asarray(np_masks[start:stop])
+    image = img_as_float(masks)
+    gradient = sum(np.square(ndimage.convolve(image, kernel, mode='reflect')) for kernel in SCHARR_KERNELS)
+    # scharr's magnitude is sqrt(gradient / 2); pixels without a label count as boundary too
+    boundary = ((gradient > 2 * BOUNDARY_THRESHOLD**2) | (masks == 0)).astype(np.uint8) * 255
+    kernel = np.ones((3,3),np.uint8)
+    for i in range(stop - start):
+        out[start + i] = np.invert(cv2.dilate(boundary[i],kernel,iterations = 1))
+
+def boundary_maps(np_masks, out=None, workers=None, slices_per_task=8):
+    """
+    Binary boundary maps of a stack of label slices: 0 on and next to the boundaries between labels and on unlabeled
+    pixels, 255 inside labels.
+    Args:
+        np_masks: (z, y, x) label stack, possibly memory-mapped.
+        out: uint8 array of the same shape to write into, e.g. a memmap, or the path of a .npy file to create and
+            memory-map. A new array when None.
+        workers: threads converting slices_per_task slices each, one per CPU when None. The gradient and threshold
+            are computed for all slices of a task at once, and OpenCV releases the GIL while dilating.
+    Returns:
+        out: the (z, y, x) uint8 boundary maps
+    """
+    shape = tuple(np.shape(np_masks))
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=np.uint8, shape=shape)
+    assert tuple(out.shape) == shape
+    tasks = [(start, min(start + slices_per_task, shape[0])) for start in range(0, shape[0], slices_per_task)]
+    with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        for done in [pool.submit(_boundary_slices, np_masks, out, start, stop) for (start, stop) in tasks]:
+            done.result()
+    return out
+
+def plot_boundary_maps(np_volume, np_masks, adjusted_masks, slices=None):
+    """Show image, labels and boundary map side by side for every slice (or the given slices), for debugging"""
+    for i in range(np.shape(np_masks)[0]) if slices is None else slices:
+        f, (ax1,ax2,ax3) = plt.subplots(1,3)
+        ax1.imshow(np.squeeze(np_volume[i,:,:]), cmap='gray')
+        ax1.set_title('image')
+        ax2.imshow(np.squeeze(np_masks[i,:,:]))
+        ax2.set_title('labels')
+        ax3.imshow(adjusted_masks[i], cmap='gray')
+        ax3.set_title('binary mask')
+        plt.show()
+
+def create_boundary_map(np_volume, np_masks, plot=False, out=None, workers=None):
+    """Boundary maps of all slices of np_masks, see boundary_maps; plot shows them next to np_volume"""
+    adjusted_masks = boundary_maps(np_masks, out, workers)
+    if plot:
+        plot_boundary_maps(np_volume, np_masks, adjusted_masks)
+    return adjusted_masks
 
 def random_crop_volume(volume,crop_size):
 
@@ -132,42 +232,181 @@ def crop_volume(volume,crop_size,indicies):
     return volume[None, d_index:d_index+d_crop,h_index:h_index+h_crop,w_index:w_index+w_crop,:]
 
 
-def load_images_and_labels(data_filepath, plot=False):
-   
-    volume = []
-    volume_tif = Image.open(os.path.join(data_filepath,'train-input.tif'))
-    for img in ImageSequence.Iterator(volume_tif):
-        volume.append(np.array(img))
-    volume = np.array(volume)
-    volume = np.divide(volume, 255.0)
-
-    seg = []
-    seg_tif = Image.open(os.path.join(data_filepath,'train-labels.tif'))
-    for m in ImageSequence.Iterator(seg_tif):
-        seg.append(np.array(m))
-    seg = np.array(seg).astype(np.uint8)
-
-    distances = [  
-                   (0,0,1),
-                   (0,1,0),
-                   (1,0,0),
-                   (0,0,3),
-                   (0,3,0),
-                   (2,0,0),
-                   (0,0,9),
-                   (0,9,0),
-                   (3,0,0),
-                   (0,0,27),
-                   (0,27,0),
-                   (4,0,0)
-                ]
-
-    ground_truth_affities = []
-    for i in range(len(distances)):
-        aff = affinitize(seg, dst=distances[i])
-        ground_truth_affities.append(aff.astype(int))
-
-    ground_truth_affities = np.array(ground_truth_affities)
+def _tiff_cache_path(path, cache_dir=None):
+    """
+    Cache file of a TIFF stack and the pattern matching all of its caches. The name holds the size and modification
+    time of the TIFF, so a changed TIFF gets a new cache.
+    """
+    info = os.stat(path)
+    directory = os.path.dirname(os.path.abspath(path)) if cache_dir is None else cache_dir
+    prefix = os.path.join(directory, '.' + os.path.basename(path))
+    return '%s.%d-%d.npy' % (prefix, info.st_size, info.st_mtime_ns), prefix + '.*.npy'
+
+def load_tiff_stack(path, cache_dir=None):
+    """
+    Frames of a multi-page TIFF as a read-only memmapped (z, y, x) array of their own dtype.
+    The first call decodes the TIFF into a .npy cache next to it (or in cache_dir), later calls only map the cache.
+    The cache is rebuilt when the size or modification time of the TIFF changes.
+    """
+    (cache, pattern) = _tiff_cache_path(path, cache_dir)
+    if not os.path.exists(cache):
+        tif = Image.open(path)
+        first = np.array(tif)
+        (handle, temporary) = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(cache))
+        os.close(handle)
+        try:
+            frames = np.lib.format.open_memmap(temporary, mode='w+', dtype=first.dtype,
+                                               shape=(getattr(tif, 'n_frames', 1),) + first.shape)
+            for (z, img) in enumerate(ImageSequence.Iterator(tif)):
+                frames[z] = np.array(img)
+            frames.flush()
+            del frames
+            os.replace(temporary, cache) #Other runs never see a partly written cache
+        except BaseException:
+            os.remove(temporary)
+            raise
+        for stale in glob.glob(pattern):
+            if stale != cache:
+                os.remove(stale)
+    return np.load(cache, mmap_mode='r')
+
+class NormalizedVolume(object):
+    """
+    Image stack that is scaled to float32 only where it is read: indexing returns float32 crops of
+    `raw * scale`, and the whole volume is never converted unless asked for with np.asarray.
+    """
+
+    def __init__(self, raw, scale=1/255.0):
+        self.raw = raw
+        self.scale = np.float32(scale)
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        return np.multiply(self.raw[index], self.scale, dtype=np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+def crop_affinities(labels, corner, crop_size, offsets=AFFINITY_OFFSETS, dtype=np.uint8):
+    """
+    Affinities of the crop of labels at corner (d, h, w) of size crop_size, as affinitize_many(labels, offsets) would
+    give them inside that crop. Only the crop and the margin its offsets reach into are read from labels.
+    """
+    shape = np.shape(labels)
+    before = [max(max(offset[axis] for offset in offsets), 0) for axis in range(3)]
+    after = [max(-min(offset[axis] for offset in offsets), 0) for axis in range(3)]
+    lo = [max(c - b, 0) for (c, b) in zip(corner, before)]
+    hi = [min(c + size + a, n) for (c, size, a, n) in zip(corner, crop_size, after, shape)]
+    margin = np.asarray(labels[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+    # affinitize_many needs every offset to fit in the volume it is given, so pad the margin up to that with
+    # background, which has no affinity to anything
+    need = [max(abs(offset[axis]) for offset in offsets) + 1 for axis in range(3)]
+    padded = np.zeros([max(n, m) for (n, m) in zip(margin.shape, need)], dtype=margin.dtype)
+    padded[:margin.shape[0], :margin.shape[1], :margin.shape[2]] = margin
+    affs = affinitize_many(padded, offsets, dtype=dtype)
+    start = [c - l for (c, l) in zip(corner, lo)]
+    return affs[:, start[0]:start[0]+crop_size[0], start[1]:start[1]+crop_size[1], start[2]:start[2]+crop_size[2]]
+
+class CropSampler(object):
+    """
+    Endless batches of random crops of an image stack with the affinities of the matching label crops, prepared ahead
+    by worker threads. Iterating yields (images, affinities): float32 (batch_size, d, h, w) crops of volume and uint8
+    (batch_size, len(offsets), d, h, w) crop_affinities. At most `prefetch` batches wait in the queue, so memory stays
+    at a few batches however large the (memory-mapped) volumes are. Call close(), or use it in a `with` block, to stop
+    the workers.
+    """
+
+    def __init__(self, volume, labels, crop_size, batch_size, offsets=AFFINITY_OFFSETS, prefetch=2, workers=1,
+                 seed=None):
+        assert np.shape(volume) == np.shape(labels)
+        assert all(c <= n for (c, n) in zip(crop_size, np.shape(volume)))
+        self.volume = volume
+        self.labels = labels
+        self.crop_size = tuple(crop_size)
+        self.batch_size = batch_size
+        self.offsets = offsets
+        self._batches = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._workers = [threading.Thread(target=self._fill, args=(np.random.default_rng(s),))
+                         for s in np.random.SeedSequence(seed).spawn(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def batch(self, rng):
+        """One batch of random crops, drawn with the numpy Generator rng"""
+        shape = np.shape(self.volume)
+        (d_crop, h_crop, w_crop) = self.crop_size
+        images = np.empty((self.batch_size,) + self.crop_size, dtype=np.float32)
+        affinities = np.empty((self.batch_size, len(self.offsets)) + self.crop_size, dtype=np.uint8)
+        for i in range(self.batch_size):
+            corner = [int(rng.integers(0, n - c + 1)) for (n, c) in zip(shape, self.crop_size)]
+            (d_index, h_index, w_index) = corner
+            images[i] = self.volume[d_index:d_index+d_crop, h_index:h_index+h_crop, w_index:w_index+w_crop]
+            affinities[i] = crop_affinities(self.labels, corner, self.crop_size, self.offsets)
+        return images, affinities
+
+    def _fill(self, rng):
+        try:
+            while not self._stop.is_set():
+                self._put(self.batch(rng))
+        except BaseException as error: #Hand the error to the consumer instead of dying silently
+            self._put(error)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._batches.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def load_crop_sampler(data_filepath, crop_size, batch_size, cache_dir=None, **kwargs):
+    """
+    CropSampler over the ISBI training images and labels, memory-mapped from their TIFF caches (see load_tiff_stack).
+    Unlike load_images_and_labels, no affinities are computed for the whole volume. kwargs go to CropSampler.
+    """
+    volume = NormalizedVolume(load_tiff_stack(os.path.join(data_filepath,'train-input.tif'), cache_dir))
+    labels = load_tiff_stack(os.path.join(data_filepath,'train-labels.tif'), cache_dir)
+    return CropSampler(volume, labels, crop_size, batch_size, **kwargs)
+
+def load_images_and_labels(data_filepath, plot=False, cache_dir=None):
+    """
+    ISBI training images, lazily normalized to [0, 1] (see NormalizedVolume), and the ground truth affinities of
+    their labels. The TIFF stacks are decoded once and cached as .npy files, see load_tiff_stack.
+    """
+    volume = NormalizedVolume(load_tiff_stack(os.path.join(data_filepath,'train-input.tif'), cache_dir))
+    seg = load_tiff_stack(os.path.join(data_filepath,'train-labels.tif'), cache_dir)
+
+    distances = AFFINITY_OFFSETS
+
+    ground_truth_affities = affinitize_many(seg, distances, dtype=np.uint8)
 
     if plot:
         for i in range(len(distances)):
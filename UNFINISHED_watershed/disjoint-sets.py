@@ -1,72 +1,125 @@
-""" 
-Not my code! Borrowed from github.com/jwasham
+"""
+Union-find over the integers 0 to size-1, stored in one NumPy array.
+
+Started from github.com/jwasham
 https://raw.githubusercontent.com/jwasham/practice-python/master/disjoint-sets/disjoint-sets.py
+and keeps its encoding: `hierarchy[i]` is the parent of i, or -(size of the set) if i is a root. Unions are by size
+and `find` halves the path as it walks it, without recursion. `find_many`, `union_many` and `flatten` work on whole
+arrays of items at once.
 """
 
-from array import array
-import os
+import numpy
 
 
 class DisjointSets(object):
 
     def __init__(self, size):
-        self.hierarchy = array('l', [0 for _ in range(size)])
-        self.names = {}
+        self.hierarchy = numpy.full(size, -1, dtype='int32' if size < 2**31 else 'int64') #Every item starts as a singleton root
+        self._parent = memoryview(self.hierarchy) #Scalar access with Python ints, much faster than indexing the array
 
-    def add(self, item_id, name):
-        self.hierarchy[item_id] = -1
-        self.names[item_id] = name
+    def __len__(self):
+        return len(self.hierarchy)
 
     def union(self, root1, root2):
-        if self.hierarchy[root1] <= self.hierarchy[root2]:   # root1 is a larger tree, since roots are -size of tree
-            self.hierarchy[root1] += self.hierarchy[root2]   # adding to increase negative value
-            self.hierarchy[root2] = root1
-        else:
-            self.hierarchy[root2] += self.hierarchy[root1]
-            self.hierarchy[root1] = root2
+        """Join the sets of roots root1 and root2 and return the root of the joined set"""
+        parent = self._parent
+        if parent[root1] <= parent[root2]:   # root1 is a larger tree, since roots are -size of tree
+            parent[root1] += parent[root2]   # adding to increase negative value
+            parent[root2] = root1
+            return root1
+        parent[root2] += parent[root1]
+        parent[root1] = root2
+        return root2
 
     def find(self, item_id):
         '''
         Finds the root of the set of which item_id is a member.
-        To speed up subsequent finds, updates the parent to root at each level in path to root.
+        To speed up subsequent finds, points every other item on the path at its grandparent (path halving).
         :param item_id:
         :return: integer representative of set
         '''
-        if self.hierarchy[item_id] < 0:
-            return item_id
-        else:
-            # path compression
-            self.hierarchy[item_id] = self.find(self.hierarchy[item_id])
-            return self.hierarchy[item_id]
+        parent = self._parent
+        while True:
+            up = parent[item_id]
+            if up < 0:
+                return item_id
+            grand = parent[up]
+            if grand < 0:
+                return up
+            parent[item_id] = grand
+            item_id = grand
+
+    def size(self, item_id):
+        """Number of items in the set of item_id"""
+        return -self._parent[self.find(item_id)]
+
+    def find_many(self, items):
+        """Roots of an array of items, pointing each of them straight at its root"""
+        items = numpy.asarray(items, dtype=self.hierarchy.dtype)
+        roots = items.copy()
+        walking = numpy.flatnonzero(self.hierarchy[roots] >= 0)
+        while len(walking) > 0:
+            roots[walking] = self.hierarchy[roots[walking]]
+            walking = walking[self.hierarchy[roots[walking]] >= 0]
+        moved = roots != items
+        self.hierarchy[items[moved]] = roots[moved]
+        return roots
+
+    def union_many(self, items1, items2):
+        """
+        Join the sets of items1[i] and items2[i] for every i. The resulting sets are those of calling union on every
+        pair in turn, but the root chosen for a set may differ.
+        """
+        (items1, items2) = (numpy.asarray(items1), numpy.asarray(items2))
+        while True:
+            (roots1, roots2) = (self.find_many(items1), self.find_many(items2))
+            apart = roots1 != roots2
+            if not apart.any():
+                return
+            (items1, items2, roots1, roots2) = (items1[apart], items2[apart], roots1[apart], roots2[apart])
+            # hook the smaller root of every pair under the larger one (ties by ID), so hooks cannot form a cycle
+            (size1, size2) = (-self.hierarchy[roots1], -self.hierarchy[roots2])
+            under = (size1 < size2) | ((size1 == size2) & (roots1 > roots2))
+            (children, index) = numpy.unique(numpy.where(under, roots1, roots2), return_index=True) # one parent each
+            parents = numpy.where(under, roots2, roots1)[index]
+            sizes = self.hierarchy[children].copy()
+            self.hierarchy[children] = parents
+            # a parent may itself have been hooked this round, so add every child's size at its final root
+            numpy.add.at(self.hierarchy, self.find_many(parents), sizes)
+
+    def flatten(self):
+        """Root of every item as an array, with every item pointed straight at its root"""
+        roots = numpy.where(self.hierarchy < 0, numpy.arange(len(self.hierarchy), dtype=self.hierarchy.dtype),
+                            self.hierarchy)
+        while True:
+            grand = roots[roots]
+            if numpy.array_equal(grand, roots):
+                break
+            roots = grand
+        moved = self.hierarchy >= 0
+        self.hierarchy[moved] = roots[moved]
+        return roots
 
     def __str__(self):
-        ret_str = repr(self.hierarchy)
-        ret_str += os.linesep + repr(self.names)
-        return ret_str
+        return repr(self.hierarchy)
 
 
 def main():
     ds = DisjointSets(10)
-    ds.add(0, "Microsoft")
-    ds.add(1, "WebTV")
-    ds.add(2, "Google")
-    ds.add(3, "DeepMind")
-    ds.add(4, "Skype")
-    ds.add(5, "Uber")
-    ds.add(6, "TinyCo")
-    ds.add(7, "TeenyTinyCo")
 
     ds.union(0, 1)
     ds.union(2, 3)
-    ds.union(0, 4)
-    ds.union(4, 6)
-    ds.union(6, 7)
-
-    # print(ds)
+    ds.union(ds.find(0), 4)
+    ds.union(ds.find(4), 6)
+    ds.union(ds.find(6), 7)
 
     assert(ds.find(3) == 2)
+    assert(ds.size(7) == 5)
 
-    # print(ds)
+    batch = DisjointSets(10)
+    batch.union_many([0, 2, 0, 4, 6], [1, 3, 4, 6, 7])
+    roots = batch.flatten()
+    assert(all((roots[i] == roots[j]) == (ds.find(i) == ds.find(j)) for i in range(10) for j in range(10)))
 
 
 if __name__ == '__main__':
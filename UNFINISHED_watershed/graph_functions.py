@@ -1,6 +1,14 @@
+import os
 import numpy
-import collections
-import disjoint-sets
+import warnings
+import importlib
+import concurrent.futures
+
+DisjointSets = importlib.import_module("disjoint-sets").DisjointSets #The module name is not a valid identifier
+try:
+    import numba_kernels #Optional compiled loops for the core kernels
+except ImportError:
+    numba_kernels = None
 
 """ 
 This is a transliteration of the code from files in Seung's Watershed.jl/src/. 
@@ -10,18 +18,189 @@ Functions in this file:
 steepestascent
 divideplateaus
 findbasins
+
+steepestascent, divideplateaus, findbasins and regiongraph have two backends giving identical results: array code in
+this file ('numpy'), and compiled loops in numba_kernels ('numba'), used when Numba is installed. The backend is chosen
+with the WATERSHED_BACKEND environment variable or set_backend(), and falls back to 'numpy' without Numba.
 """
 
+# Directions of the 6-bit steepest ascent graph encoding as (axis, step), in the order -x, -y, -z, +x, +y, +z
+DIRECTIONS = [(0, -1), (1, -1), (2, -1), (0, 1), (1, 1), (2, 1)]
+DIR_MASK  = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20]
+IDIR_MASK = [0x08, 0x10, 0x20, 0x01, 0x02, 0x04]
+# The steepest ascent graph uses 6 direction bits and divideplateaus one more to mark visited voxels
+SAG_DTYPE = 'uint8'
+# Voxels relabeled per step by `relabel`
+RELABEL_SLAB_SIZE = 1 << 24
+# Smallest z-slab, in voxels, that regiongraph hands to a worker thread of its own
+REGIONGRAPH_SLAB_VOXELS = 1 << 21
+# Backends of the core kernels, see set_backend
+BACKENDS = ('numpy', 'numba')
+# LAST_DIR[bits] keeps only the highest direction bit of a 6-bit edge set
+LAST_DIR = numpy.array([0] + [1 << (bits.bit_length() - 1) for bits in range(1, 64)], dtype=SAG_DTYPE)
+
+def label_dtype(max_label):
+    """uint32 for segmentations whose IDs fit in it, uint64 beyond"""
+    return numpy.dtype('uint32') if max_label < 2**32 else numpy.dtype('uint64')
+
+def affinity_scale(dtype):
+    """
+    Affinity represented by one unit of an affinity array: 1 for floating point arrays, 1/255 for uint8-quantized
+    ones (1/65535 for uint16). Thresholds and region graph weights are always in affinity units
+    """
+    dtype = numpy.dtype(dtype)
+    return 1.0 / numpy.iinfo(dtype).max if dtype.kind in 'ui' else 1.0
+
+def weight_threshold(threshold, dtype, inclusive=False):
+    """
+    Threshold on region graph weights of dtype affinities that agrees with steepestascent, which compares quantized
+    affinities with thresholds exactly in their own units: a weight is above the result (or equal to it if `inclusive`)
+    exactly when its quantized affinity is above `threshold` (or equal to it). float32 weights of levels can round to
+    either side of a threshold, so it is snapped to the weight of the highest level not above it (the lowest level not
+    below it if `inclusive`). Floating point affinities have exact weights and keep their threshold.
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == 'f':
+        return threshold
+    units = threshold / affinity_scale(dtype)
+    level = numpy.ceil(units) if inclusive else numpy.floor(units)
+    return float(numpy.float32(level) * numpy.float32(affinity_scale(dtype))) # as regiongraph scales its weights
+
+def set_backend(name):
+    """
+    Run the core kernels on backend `name`, one of BACKENDS, and return the previous backend. Asking for 'numba'
+    without Numba installed warns and keeps 'numpy'.
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend " + repr(name) + ", expected one of " + str(BACKENDS))
+    if name == 'numba' and numba_kernels is None:
+        warnings.warn("Numba is not installed, using the numpy backend")
+        name = 'numpy'
+    (previous, _backend) = (_backend, name)
+    return previous
+
+def get_backend():
+    """Name of the backend the core kernels run on"""
+    return _backend
+
+_backend = 'numpy'
+set_backend(os.environ.get('WATERSHED_BACKEND', 'numba' if numba_kernels is not None else 'numpy'))
+
+def _compiled(*arrays):
+    """Whether to run on the numba backend, which handles all dtypes but float16 and volumes below 2^31 voxels"""
+    return (_backend == 'numba' and all(a.dtype != numpy.float16 for a in arrays)
+            and all(a.size < 2**31 for a in arrays))
+
+def _layout(arr):
+    """
+    'F' for Fortran-ordered arrays, 'C' for all others. Flat indices in this order follow memory, so ravel and reshape
+    in it give views of a contiguous array instead of copies
+    """
+    return 'F' if arr.flags.f_contiguous and not arr.flags.c_contiguous else 'C'
+
+def _contiguous(arr):
+    """arr itself if it is C- or Fortran-contiguous, else a C-contiguous copy"""
+    return arr if arr.flags.c_contiguous or arr.flags.f_contiguous else numpy.ascontiguousarray(arr)
+
+def _voxel_strides(arr):
+    """Distance between neighboring voxels along each axis of arr in flat (memory order) indices"""
+    return [stride // arr.itemsize for stride in arr.strides]
+
+def _shifted(d):
+    """
+    Slices (here, there, edge) for direction d: `vol[there]` holds the neighbor in direction d of every voxel of
+    `vol[here]`, and `vol[edge]` holds the boundary voxels that have no neighbor in that direction.
+    """
+    (axis, step) = DIRECTIONS[d]
+    here = [slice(None)] * 3
+    there = [slice(None)] * 3
+    edge = [slice(None)] * 3
+    if step < 0:
+        (here[axis], there[axis], edge[axis]) = (slice(1, None), slice(None, -1), slice(0, 1))
+    else:
+        (here[axis], there[axis], edge[axis]) = (slice(None, -1), slice(1, None), slice(-1, None))
+    return tuple(here), tuple(there), tuple(edge)
+
+def _neighbor_affinity(aff, d):
+    """View of the affinity between every voxel of `vol[here]` and its neighbor in direction d"""
+    (axis, step) = DIRECTIONS[d]
+    (here, there, edge) = _shifted(d)
+    # aff[x,y,z,axis] links a voxel to its negative neighbor, so a positive neighbor's affinity is stored at the neighbor
+    return aff[(here if step < 0 else there) + (axis,)]
+
+class RegionGraph(object):
+    """
+    Region graph or region tree in columnar form. `weights` (float32) holds the weight of every edge and the rows of
+    `ids` (uint32, or uint64 for larger IDs) its (id1, id2) pair; `id1` and `id2` are views of the columns of `ids`.
+    Iterating yields (weight, id1, id2) tuples and slicing gives a RegionGraph of the selected edges.
+    """
+
+    def __init__(self, weights, ids):
+        self.weights = numpy.asarray(weights)
+        self.ids = numpy.asarray(ids)
+        assert self.ids.shape == (len(self.weights), 2)
+
+    @classmethod
+    def empty(cls, nedges, max_segid=0):
+        """Region graph of nedges zero edges between IDs up to max_segid, to be filled in column by column"""
+        return cls(numpy.zeros(nedges, dtype='float32'), numpy.zeros((nedges, 2), dtype=label_dtype(max_segid)))
+
+    @property
+    def id1(self):
+        return self.ids[:, 0]
+
+    @property
+    def id2(self):
+        return self.ids[:, 1]
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __iter__(self):
+        return zip(self.weights.tolist(), self.id1.tolist(), self.id2.tolist())
+
+    def __getitem__(self, index):
+        if numpy.ndim(index) == 0 and not isinstance(index, slice):
+            return (self.weights[index], self.ids[index, 0], self.ids[index, 1])
+        return RegionGraph(self.weights[index], self.ids[index])
+
+    def __repr__(self):
+        return "RegionGraph(" + str(len(self)) + " edges)"
+
+def as_regiongraph(rg):
+    """A RegionGraph from a RegionGraph (returned as is), a (weight,id1,id2) record array or a list of such tuples"""
+    if isinstance(rg, RegionGraph):
+        return rg
+    if isinstance(rg, numpy.ndarray) and rg.dtype.names is not None:
+        (weights, id1, id2) = (rg[name] for name in rg.dtype.names)
+    else:
+        (weights, id1, id2) = (numpy.array(column) for column in zip(*rg)) if len(rg) > 0 else ([], [], [])
+    max_segid = max(int(numpy.max(id1)), int(numpy.max(id2))) if len(weights) > 0 else 0
+    return RegionGraph(numpy.asarray(weights, dtype='float32'),
+                       numpy.stack((id1, id2), axis=1).astype(label_dtype(max_segid)).reshape(-1, 2))
+
+def _edge_arrays(rg):
+    """Weights, id1 and id2 of a region graph in any form as_regiongraph accepts"""
+    rg = as_regiongraph(rg)
+    return rg.weights, rg.id1, rg.id2
+
+def _exceeds(values, threshold, inclusive=False):
+    """Compare against a threshold in double precision, as the reference loop does with Python floats"""
+    compare = numpy.greater_equal if inclusive else numpy.greater
+    return compare(values, threshold, signature=(numpy.float64, numpy.float64, numpy.bool_))
+
 """
 The first function attempts to construct the steepest ascent graph from a given affinity graph. 
 
 Inputs:
-* `aff`: affinity graph (undirected and weighted). 4D array of affinities, where last dimension is of size 3
+* `aff`: affinity graph (undirected and weighted). 4D array of affinities, where last dimension is of size 3. It can be
+  float32, float16 or quantized to uint8 (see `affinity_scale`), and a read-only numpy.memmap
 * `low`: edges with affinity <= `low` are removed
 * `high`: affinities >= `high` are considered infinity
 
 Returns:
-* `sag`: steepest ascent graph (directed and unweighted). `sag[x,y,z]` contains 6-bit number enocoding edges outgoing from (x,y,z)
+* `sag`: steepest ascent graph (directed and unweighted). `sag[x,y,z]` contains 6-bit number enocoding edges outgoing from (x,y,z), as uint8
 
 IMPORTANT: Julia is 1-indexed but Python is 0-indexed, so the affinity graph convention probably changes as so.
 We follow the convention that:
@@ -32,35 +211,32 @@ We follow the convention that:
 """
 
 def steepestascent(aff, low, high):
-    assert numpy.ma.size(aff, 4) == 3 #This gives us the size of the matrix along axis 4
+    assert aff.ndim == 4 and aff.shape[3] == 3
     (xdim, ydim, zdim) = aff.shape[:3] #Get the size of the affinity graph (first three axes of aff)
-    sag = numpy.zeros((xdim, ydim, zdim), dtype='uint32')
-
-    for z in range(zdim):
-        for y in range(ydim):
-            for x in range(xdim):
-                negx = aff[x, y, z, 0] if x > 0 else low
-                negy = aff[x, y, z, 1] if y > 0 else low
-                negz = aff[x, y, z, 2] if z > 0 else low
-                posx = aff[x+1, y, z, 0] if x < (xdim-1) else low
-                posy = aff[x, y+1, z, 1] if y < (ydim-1) else low
-                posz = aff[x, y, z+1, 2] if z < (zdim-1) else low
-            
-                m = numpy.amax([negx, negy, negz, posx, posy, posz])
-
-                if m > low:
-                    if (negx == m or negx >= high):
-                        sag[x, y, z] |= 0x01
-                    if (negy == m or negy >= high):
-                        sag[x, y, z] |= 0x02
-                    if (negz == m or negz >= high):
-                        sag[x, y, z] |= 0x04
-                    if (posx == m or posx >= high):
-                        sag[x, y, z] |= 0x08
-                    if (posy == m or posz >= high):
-                        sag[x, y, z] |= 0x10
-                    if (posz == m or posz >= high):
-                        sag[x, y, z] |= 0x20
+    order = _layout(aff[..., 0])  # sag follows the memory order of aff, so later stages can work on it in place
+    sag = numpy.zeros((xdim, ydim, zdim), dtype=SAG_DTYPE, order=order)
+    (low, high) = (low / affinity_scale(aff.dtype), high / affinity_scale(aff.dtype))  # in the units of aff
+    if _compiled(aff):
+        return numba_kernels.steepestascent(numpy.asarray(aff), low, high, sag, order == 'F')
+
+    # Largest affinity to an existing neighbor. Missing neighbors on the volume boundary count as `low`, which can
+    # never be the maximum of a voxel with m > low, so they only take part in the `>= high` test below.
+    # m keeps the dtype of aff, so the comparisons below are exact and a float16 or uint8 volume stays small
+    floor = -numpy.inf if aff.dtype.kind == 'f' else numpy.iinfo(aff.dtype).min
+    m = numpy.full((xdim, ydim, zdim), floor, dtype=aff.dtype, order=order)
+    for d in range(6):
+        (here, there, edge) = _shifted(d)
+        numpy.maximum(m[here], _neighbor_affinity(aff, d), out=m[here])
+    ascending = _exceeds(m, low)
+
+    for d in range(6):
+        (here, there, edge) = _shifted(d)
+        neighbor = _neighbor_affinity(aff, d)
+        steepest = (neighbor == m[here]) | _exceeds(neighbor, high, inclusive=True)
+        steepest &= ascending[here]
+        numpy.bitwise_or(sag[here], DIR_MASK[d], out=sag[here], where=steepest)
+        if low >= high:
+            numpy.bitwise_or(sag[edge], DIR_MASK[d], out=sag[edge], where=ascending[edge])
     return sag
     
 """
@@ -73,49 +249,116 @@ Input:
 
 Returns:
 Modified sag
+
+Plateaus are divided by a BFS from their exits that runs one level at a time, so a voxel at distance k from an exit
+is pointed at a neighbor at distance k-1. Ties between several such neighbors go to the last direction, as in the
+original per-voxel queue.
 """
 def divideplateaus(sag):
-    (xdim, ydim, zdim) = sag.shape()
-
-    dir_array = [-1, -xdim, -xdim*ydim, 1, xdim, xdim*ydim]    
-    dir_mask  = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20]
-    idir_mask = [0x08, 0x10, 0x20, 0x01, 0x02, 0x04]
-    bfs = []
+    if _compiled(sag):
+        return numba_kernels.divideplateaus(sag, _layout(sag) == 'F')
+    sag = _contiguous(sag)
+    order = _layout(sag)
+    strides = _voxel_strides(sag)
+    dir_array = [step * strides[axis] for (axis, step) in DIRECTIONS]
+
+    # Split the outgoing edges of every voxel into exits (the neighbor has no edge back) and plateau edges (it does)
+    exits = numpy.zeros_like(sag)
+    plateau = numpy.zeros_like(sag)
+    for d in range(6):
+        (here, there, edge) = _shifted(d)
+        outgoing = (sag[here] & DIR_MASK[d]) != 0
+        incoming = (sag[there] & IDIR_MASK[d]) != 0
+        numpy.bitwise_or(exits[here], DIR_MASK[d], out=exits[here], where=outgoing & ~incoming)
+        numpy.bitwise_or(plateau[here], DIR_MASK[d], out=plateau[here], where=outgoing & incoming)
+
+    # Voxels with an exit and no plateau edge just keep their last exit. Those that also sit on a plateau seed the BFS
+    leaving = exits != 0
+    on_plateau = plateau != 0
+    lone = leaving & ~on_plateau
+    sag[lone] = LAST_DIR[exits[lone]]
+    seeds = leaving & on_plateau
+    sag[seeds] |= 0x40
+    seeds = numpy.flatnonzero(numpy.ravel(seeds, order))
+    # Only plateau voxels are ever queued, so the queue is sized by the plateaus rather than the volume
+    queue = numpy.empty(len(seeds) + numpy.count_nonzero(on_plateau & ~leaving), dtype='int64')
+    del exits, plateau, leaving, on_plateau, lone
 
     """ 
-    Julia has flat indexing of arrays, which seems to be the Fortran-style "row index changes fastest". I try to replicate this
-    by flattening the python array and indexing into it using a scalar, rather than doing some index arithmetic
+    Julia has flat indexing of arrays, which follows its (Fortran) memory order. I replicate this by flattening the
+    python array in its own memory order, a view of it, and indexing into it using a scalar, with the neighbor in every
+    direction at a fixed offset given by the strides
     """
-    flat_sag = numpy.ravel(sag, 'F') #'F' for 'F'ortran
-    total_length = len(flat_sag)
-
-    #Queue vertices that have purely outgoing edges
-    for idx in range(total_length):
+    flat_sag = numpy.ravel(sag, order)
+
+    #Divide plateaus one BFS level at a time. Every voxel of a level points to an exit or to a voxel of an earlier
+    #level, whose edges have already been reduced to one that cannot point back
+    queue[:len(seeds)] = seeds
+    (head, tail) = (0, len(seeds))
+    while head < tail:
+        frontier = queue[head:tail]
+        edges = flat_sag[frontier]
+        coords = numpy.unravel_index(frontier, sag.shape, order=order)
+        to_set = numpy.zeros(len(frontier), dtype=sag.dtype)
+        found = []
         for d in range(6):
-            if (flat_sag[idx] & dir_mask[d]) != 0: #Outgoing edge exists
-                if (flat_sag[idx+dir_array[d]] & idir_mask[d]) == 0: #No incoming edge
-                    flat_sag[idx] |= 0x40
-                    bfs.append(idx)
-                    break
-    
-            
-    #Divide plateaus
-    bfs_len = len(bfs)
-    for bfs_index in range(bfs_len):
-        idx = bfs[bfs_index]
-        to_set = 0
-        for d in range(6):
-            if (flat_sag[idx] & dir_mask[d]) != 0: #Outgoing edge exists
-                if (flat_sag[idx+dir_array[d]] & idir_mask[d]) != 0: #Incoming edge exists
-                    if (flat_sag[idx+dir_array[d] & 0x40) == 0:
-                        bfs.append(idx+dir_array[d])
-                        flat_sag[idx+dir_array[d]] |= 0x40
-                    else:
-                        to_set = dir_mask[d]
-        flat_sag[idx] = to_set
-    sag = numpy.reshape(flat_sag, (xdim, ydim, zdim), 'F')
+            (axis, step) = DIRECTIONS[d]
+            inside = coords[axis] != (0 if step < 0 else sag.shape[axis]-1) #Boundary voxels can have edges leaving the volume when low >= high
+            outgoing = numpy.flatnonzero(((edges & DIR_MASK[d]) != 0) & inside) #Outgoing edge to a voxel exists
+            neighbors = frontier[outgoing] + dir_array[d]
+            targets = flat_sag[neighbors]
+            incoming = (targets & IDIR_MASK[d]) != 0
+            to_set[outgoing[~incoming]] = DIR_MASK[d]
+            found.append(neighbors[incoming & ((targets & 0x40) == 0)]) #Not yet visited
+        flat_sag[frontier] = to_set
+        found = numpy.unique(numpy.concatenate(found))
+        flat_sag[found] |= 0x40
+        queue[tail:tail+len(found)] = found
+        (head, tail) = (tail, tail + len(found))
     return sag
 
+def relabel(seg, lookup, slab_size=RELABEL_SLAB_SIZE):
+    """
+    Replace every segment ID in seg by lookup[ID], in place. seg can be any array, including a numpy.memmap; it is
+    processed slab_size voxels at a time, so only one slab of temporary storage is needed.
+    """
+    lookup = numpy.asarray(lookup, dtype=seg.dtype)
+    if seg.flags.c_contiguous or seg.flags.f_contiguous:
+        flat_seg = numpy.ravel(seg, 'K')  # a view in memory order
+        for start in range(0, len(flat_seg), slab_size):
+            slab = flat_seg[start:start+slab_size]
+            numpy.take(lookup, slab, out=slab)
+    else:
+        step = max(slab_size // max(seg[0].size, 1), 1)
+        for start in range(0, seg.shape[0], step):
+            seg[start:start+step] = numpy.take(lookup, seg[start:start+step])
+    return seg
+
+def _jump(parent, slab_size=RELABEL_SLAB_SIZE):
+    """
+    Point every vertex of a forest straight at its root by pointer jumping. May return a new array. Each pass looks up
+    slab_size vertices at a time, so the only temporary the size of parent is the buffer it alternates with.
+    """
+    grand = numpy.empty_like(parent)
+    while True:
+        for start in range(0, len(parent), slab_size):
+            grand[start:start+slab_size] = parent[parent[start:start+slab_size]]
+        if numpy.array_equal(grand, parent):
+            return parent
+        (parent, grand) = (grand, parent)
+
+def _components(n, u, v):
+    """Root of the connected component of each of n vertices joined by edges (u, v); roots are the smallest vertices"""
+    parent = numpy.arange(n, dtype=u.dtype)
+    while True:
+        (ru, rv) = (parent[u], parent[v])
+        apart = ru != rv
+        if not apart.any():
+            return parent
+        # hook the larger root under the smaller one, so parent pointers only ever decrease and cannot form cycles
+        numpy.minimum.at(parent, numpy.maximum(ru[apart], rv[apart]), numpy.minimum(ru[apart], rv[apart]))
+        parent = _jump(parent)
+
 """
 Find basins of attraction
 
@@ -123,7 +366,7 @@ Inputs:
 * `sag`: steepest ascent graph (directed and unweighted). `sag[x,y,z]` contains 6-bit number encoding edges outgoing from (x,y,z)
 
 Returns:
-* `seg`: segmentation into basins.  Each element of the 3D array contains a *basin ID*, a nonnegative integer ranging from 0 to the number of basins.
+* `seg`: segmentation into basins.  Each element of the 3D array contains a *basin ID*, a nonnegative integer ranging from 0 to the number of basins. uint32, or uint64 if there are 2^32 basins or more.
 * `counts`: number of voxels in each basin
 * `counts0`: number of background voxels
 
@@ -131,199 +374,323 @@ A value of 0 in `seg` indicates a background voxel, which has no edges
 at all in the steepest ascent graph.  All such singletons are given
 the same ID of 0, although they are technically basins by themselves.
 
-The algorithm starts from an unassigned voxel, and identifies all
-downstream voxels via breadth-first search (BFS). The search
-terminates in two possible ways:
-
-1. downstream voxel that was previously assigned a basin ID =>
-assign that ID to queued voxels.
-2. no more downstream voxels => assign new basin ID to queued voxels.
-
-Then the queue is emptied, and BFS begins anew at an unassigned voxel.
-The algorithm ends when all voxels are assigned.
-
-The 7th bit (0x40) is used to indicate whether a voxel has been
-visited during BFS.
-
-The MSB indicates whether a voxel has been assigned a basin ID.  The MSB definition is given in the functions at the end of the file for UInt32 and UInt64 cases.
-
 `findbasins` is applied to the steepest ascent graph after modification by `divideplateaus`  By this point all paths are unique, except in maximal plateaus.
+Every voxel outside a maximal plateau therefore has a single outgoing edge, and following it gives a *parent*. Each
+maximal plateau is first collapsed onto one root voxel by hooking its edges, after which the parents form a forest
+and every voxel reaches its root by pointer jumping (repeated `parent = parent[parent]`), in a number of whole-array
+passes logarithmic in the longest path. Basin IDs are numbered in order of the first voxel of each basin in the
+memory order of sag, which is the order in which the original voxel-by-voxel BFS created them (Julia arrays being
+Fortran-ordered). All flat indices follow memory order, so no stage copies the volume to reorder it.
 """
 def findbasins(sag):
-    (xdim,ydim,zdim) = sag.shape()
-    dir_array = [-1, -xdim, -xdim*ydim, 1, xdim, xdim*ydim]
-    dir_mask  = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20]
-    counts0 = 0  # number of background voxels
-    counts = []  # voxel counts for each basin
-    bfs = []
-    next_id = 1   # initialize basin ID
- 
-    flat_sag = numpy.ravel(sag, 'F') #To enable flat indexing once again - 'F' for 'F'ortran
-    total_length = len(flat_sag)
-
-    for idx in range(total_length):
-        if flat_sag[idx] == 0: #No edges - background voxel
-            flat_sag[idx] |= 0x80000000 #This is used to get the MSB, under the assumption that sag is composed of uint32. TODO: Check this assumption
-            counts0 += 1
-        elif (seg[idx] & 0x80000000) == 0:  # not yet assigned
-            bfs.append(idx)     # enqueue
-            seg[idx] |= 0x40    # mark as visited
-            bfs_len = len(bfs)
-            for bfs_index in range(bfs_len):
-                me = bfs[bfs_index]
-                for d in range(6):
-                    if (flat_sag[me] & dir_mask[d]) != 0:  # outgoing edge
-                        him = me + dir_array[d]  # target of edge
-                        if (flat_sag[him] & 0x80000000) != 0: # already assigned
-                            for it in bfs:  # assign entire queue to same ID
-                                flat_sag[it] = flat_sag[him]  # including high bit
-                            counts[flat_sag[him] & 0x80000000] += length(bfs);
-                            bfs = []  # empty queue
-                            break
-                        elif (seg[him] & 0x40) == 0:  # not visited
-                            seg[him] |= 0x40    # mark as visited
-                            bfs.append(him)    # enqueue
-                        # else ignore since visited (try next direction)
-                bfs_index += 1      # go to next vertex in queue
-            if len(bfs) != 0     # new basin has been created
-                counts.append(len(bfs))
-                for it in bfs
-                    seg[it] = 0x80000000 | next_id    # assign a basin ID
-                next_id += 1
-                bfs = []
-
-    print("Found: ", str(next_id-1)," components")
-
-    for idx in range(total_length): 
-        flat_sag[idx] &= 0x7fffffff     # clear MSB
-    end
-
-    seg = numpy.reshape(flat_sag, (xdim, ydim, zdim), 'F')
+    sag = _contiguous(sag)
+    order = _layout(sag)
+    if _compiled(sag):
+        (flat_seg, counts, counts0) = numba_kernels.findbasins(numpy.ravel(sag, order), numpy.array(sag.shape),
+                                                               numpy.array(_voxel_strides(sag)))
+        print("Found: ", str(len(counts))," components")
+        return numpy.reshape(flat_seg, sag.shape, order), counts, counts0
+    total_length = sag.size
+    index_type = 'int32' if total_length < 2**31 else 'int64'
+
+    # A parent pointer per voxel, starting at its own flat index in memory order (as Julia would number them)
+    parent = numpy.arange(total_length, dtype=index_type)
+    parent3d = numpy.reshape(parent, sag.shape, order)
+    strides = _voxel_strides(sag)
+    plateau = numpy.zeros_like(sag)  # plateau edges of every voxel, in the positive directions only
+    for d in range(6):
+        (here, there, edge) = _shifted(d)
+        (axis, step) = DIRECTIONS[d]
+        outgoing = (sag[here] & DIR_MASK[d]) != 0
+        incoming = (sag[there] & IDIR_MASK[d]) != 0
+        # edges into background voxels only occur when low >= high and lead nowhere, so they are ignored.
+        # A voxel has at most one edge off a plateau, so its parent is still its own index here
+        numpy.add(parent3d[here], step * strides[axis], out=parent3d[here], where=outgoing & ~incoming & (sag[there] != 0))
+        if step > 0: # every plateau edge also appears in the opposite direction
+            numpy.bitwise_or(plateau[here], DIR_MASK[d], out=plateau[here], where=outgoing & incoming)
+
+    # Collapse each maximal plateau onto its smallest voxel by hooking the roots of the two ends of every plateau edge
+    # into parent, one direction at a time, until no plateau edge joins two roots
+    hooked = plateau.any()
+    while hooked:
+        parent = _jump(parent)
+        parent3d = numpy.reshape(parent, sag.shape, order)
+        hooked = False
+        for d in range(3, 6):
+            (here, there, edge) = _shifted(d)
+            (ru, rv) = (parent3d[here], parent3d[there])
+            apart = ((plateau[here] & DIR_MASK[d]) != 0) & (ru != rv)
+            if apart.any():
+                (ru, rv) = (ru[apart], rv[apart])
+                # hook the larger root under the smaller one, so parent pointers only ever decrease
+                lower = numpy.minimum(ru, rv)
+                numpy.minimum.at(parent, numpy.maximum(ru, rv, out=ru), lower)
+                del lower
+                hooked = True
+    del plateau, parent3d
+
+    parent = _jump(parent)
+
+    foreground = numpy.ravel(sag != 0, order)
+    counts0 = total_length - numpy.count_nonzero(foreground)  # number of background voxels
+
+    # Number the basins in order of their first voxel
+    index = numpy.arange(total_length, dtype=index_type)
+    voxels = index[foreground]
+    roots = index[foreground & (parent == index)]
+    rank = index # reuse the buffer, only root entries are read back
+    rank[roots] = numpy.arange(len(roots), dtype=index_type)
+    # basin, first voxel and voxel count of every basin, a slab of voxels at a time to bound the temporaries
+    slabs = [slice(start, start+RELABEL_SLAB_SIZE) for start in range(0, len(voxels), RELABEL_SLAB_SIZE)]
+    del foreground
+    basin = numpy.empty_like(voxels)
+    for slab in slabs:
+        basin[slab] = parent[voxels[slab]]
+        basin[slab] = rank[basin[slab]]
+    del parent, rank, index
+    first = numpy.full(len(roots), total_length, dtype=index_type)
+    counts = numpy.zeros(len(roots), dtype='int64')
+    for slab in slabs:
+        numpy.minimum.at(first, basin[slab], voxels[slab])
+        counts += numpy.bincount(basin[slab], minlength=len(roots))
+    by_first = numpy.argsort(first)
+    del first
+    seg_type = label_dtype(len(roots))
+    basin_id = numpy.zeros(len(roots), dtype=seg_type)
+    basin_id[by_first] = numpy.arange(1, len(roots)+1, dtype=seg_type)
+
+    flat_seg = numpy.zeros(total_length, dtype=seg_type)
+    for slab in slabs:
+        flat_seg[voxels[slab]] = basin_id[basin[slab]]
+    counts = counts[by_first]  # voxel counts for each basin
+    print("Found: ", str(len(roots))," components")
+
+    seg = numpy.reshape(flat_seg, sag.shape, order)
     return seg, counts, counts0
 
 """
 merge small regions by agglomerative clustering
 
-    new_rg = mergeregions(seg, rg, counts, thresholds, dust_size = 0)
+    new_rg, new_counts = mergeregions(seg, rg, counts, thresholds, dust_size = 0, record = None)
 
 Inputs:
 * `seg` - segmentation.  IDs of foreground regions are 1:length(counts).  ID=0 for background.  This is modified in place by the clustering.
-* `rg`: region graph as list of edges, array of (weight,id1,id2) tuples. The edges should be presorted so that weights are in descending order. Region IDs should be consistent with those in `seg`, except no zeros.
-* `counts`: sizes of regions in `seg` (modified in place)
+* `rg`: region graph as a RegionGraph (or list of (weight,id1,id2) tuples). The edges should be presorted so that weights are in descending order. Region IDs should be consistent with those in `seg`, except no zeros.
+* `counts`: sizes of regions in `seg`, `counts[i]` being the size of region i+1
 * `thresholds`: sequence of (size_th,weight_th) pairs to be used for merging
 * `dust_size`: after merging, tiny regions less than dust_size to be eliminated by changing them to background voxels
+* `record`: optional dict (such as the record of instrumentation.measure) that receives the number of `merges` performed and the number of regions removed as `dust`
 
 Returns:
-* `new_rg`: new region graph after clustering, same format as `rg`.
+* `new_rg`: new region graph after clustering, a RegionGraph.
+* `new_counts`: sizes of the regions left after clustering, same format as `counts`.
 
 Agglomerative clustering proceeds by considering the edges of the region graph in sequence.  If either region has size less than `size_th`, then merge the regions. When the weight of the edge in the region graph is less than or equal to `weight_th`, agglomeration proceeds to the next `(size_th,weight_th)` in `thresholds` or terminates if there is none.
 """
-def mergeregions(seg, rg, counts, thresholds, dust_size=0):
+def mergeregions(seg, rg, counts, thresholds, dust_size=0, record=None):
     counts_len = len(counts)
-    sets = DisjointSets(counts_len) #Using DisjointSets object from third-party code. Must check TODO
+    sizes = numpy.zeros(counts_len+1, dtype='int64') #Region sizes indexed by region ID, Julia style
+    sizes[1:] = counts
+    sets = DisjointSets(counts_len+1)
+    merges = 0
+    rg = as_regiongraph(rg)
     for (size_th, weight_th) in thresholds:
         for (weight, id1, id2) in rg:
             s1 = sets.find(id1)
             s2 = sets.find(id2)
             if (weight > weight_th) and (s1 != s2):
-                if (counts[s1] < size_th) or (counts[s2] < size_th):
-                    counts[s1] += counts[s2]
-                    counts[s2] = 0
-                    sets.union(s1, s2)
-                    s = sets.find(s1)   # this is either s1 or s2
-                    (counts[s], counts[s1]) = (counts[s1], counts[s]) #Is this just swapping elements?
+                if (sizes[s1] < size_th) or (sizes[s2] < size_th):
+                    sizes[s1] += sizes[s2]
+                    sizes[s2] = 0
+                    s = sets.union(s1, s2)   # this is either s1 or s2
+                    merges += 1
+                    (sizes[s], sizes[s1]) = (sizes[s1], sizes[s]) #Move the merged size to the new root
     print("Done merging")
 
-    # define mapping from parents to new segment IDs
+    # define mapping from parents to new segment IDs, numbered in order of the smallest old ID of every region kept,
     # and apply to redefine counts
-    remaps = numpy.zeros(counts_len)     
-    next_id = 1 
-    for idx in range(counts_len):
-        s = sets.find(idx)
-        if (remaps[s] == 0) and (counts[s] >= dust_size): 
-            remaps[s] = next_id
-            counts[next_id] = counts[s]    
-            next_id += 1 
-    counts = counts[:next_id-1] #TODO ensure this is the same as resize!()
+    roots = sets.flatten()[1:]
+    kept = numpy.flatnonzero(sizes[roots] >= dust_size)
+    (kept_roots, first) = numpy.unique(roots[kept], return_index=True)
+    kept_roots = kept_roots[numpy.argsort(first)]
+    next_id = len(kept_roots) + 1
+    remaps = numpy.zeros(counts_len+1, dtype=seg.dtype)
+    remaps[kept_roots] = numpy.arange(1, next_id, dtype=seg.dtype)
+    lookup = numpy.zeros(counts_len+1, dtype=seg.dtype)  # new segment ID of every old one, 0 for dust
+    lookup[1:] = remaps[roots]
+    new_counts = sizes[kept_roots].astype(counts.dtype)
 
     # apply remapping to voxels in seg
     # note that dust regions will get assigned to background
-    flat_seg = numpy.ravel(seg, 'F')
-    for idx in range(len(flat_seg)):
-        if flat_seg[idx] != 0:    # only foreground voxels
-            flat_seg[idx] = remaps[sets.find(flat_seg[idx])]
-    seg = numpy.reshape(flat_seg, seg.shape(), 'F')
+    relabel(seg, lookup)
     print("Done with remapping, total: ", str(next_id-1), " regions")
-
-    # apply remapping to region graph
-    in_rg = [[0]] * (next_id-1)
-    new_rg = []
-    for (weight, id1, id2) in rg:
-        s1 = remaps[sets.find(id1)]
-        s2 = remaps[sets.find(id2)]
-        if (s1 != s2) and (s1 != 0) and (s2 != 0):  # ignore dust regions
-            (s1,s2) = (min(s1,s2), max(s1, s2))
-            if s2 not in in_rg[s1]:
-                new_rg.append((weight, s1, s2))
-                in_rg[s1].append(s2)
+    if record is not None:
+        # every merge leaves one region fewer, and the regions left after merging are either kept or dust
+        record.update(merges=merges, dust=counts_len-merges-(next_id-1))
+
+    # apply remapping to region graph, keeping the first (heaviest) edge between every pair of new regions
+    (weights, id1, id2) = _edge_arrays(rg)
+    (s1, s2) = (lookup[id1], lookup[id2])
+    kept = numpy.flatnonzero((s1 != s2) & (s1 != 0) & (s2 != 0))  # ignore dust regions
+    pairs = numpy.stack((numpy.minimum(s1[kept], s2[kept]), numpy.maximum(s1[kept], s2[kept])), axis=1)
+    first = numpy.sort(numpy.unique(pairs, axis=0, return_index=True)[1]) if len(kept) > 0 else kept
+    new_rg = RegionGraph(weights[kept[first]], pairs[first].astype(label_dtype(next_id-1)))
     print("Done with updating the region graph, size: ", str(len(new_rg)))
-    return new_rg
+    return new_rg, new_counts
 
 """
 compute maximal spanning tree from weighted graph
 
 Inputs:
-* `rg`: region graph as list of edges, array of (weight,id1,id2)
-  tuples.  The edges should be presorted so that weights are in
+* `rg`: region graph as a RegionGraph (or list of (weight,id1,id2)
+  tuples).  The edges should be presorted so that weights are in
   descending order.
 * `max_segid`: largest ID in region graph
 
 Returns:
-* `regiontree`: *maximal* spanning tree (MST) of region graph as list of edges, array of `(weight,id1,id2)` tuples. The vertices in each edge are ordered so that `id2` is unique across edges. In other words, id1 and id2 correspond to parent and child in the tree. The code places the root of the tree at segid=1
+* `regiontree`: *maximal* spanning tree (MST) of region graph as a RegionGraph of `(weight,id1,id2)` edges. The vertices in each edge are ordered so that `id2` is unique across edges. In other words, id1 and id2 correspond to parent and child in the tree. The code places the root of the tree at segid=1
+
+The tree is the one Kruskal's algorithm picks when it scans the edges in the given order, and it lists its edges in
+that order. It is found with Boruvka rounds instead of an edge-by-edge scan: every component takes its earliest
+incident edge, the components joined this way are merged by hooking and pointer jumping (`_components`, over int32
+or int64 indices depending on the size of the graph), and the rounds repeat until no edge joins two components. Using the edge position to break ties between equal weights makes the result identical
+to Kruskal's. Each tree (one per connected component) is then rooted at its smallest segid, and a level-synchronous
+BFS over a CSR adjacency gives the depths that decide which vertex of an edge is the parent.
 """
 def mst(rg, max_segid):
-    regiontree = []
-    adjacency=[[]] * max_segid    # adjacency list
-
-    # Kruskal's algorithm
-    sets = DisjointSets(max_segid)
-    for e in rg:
-        (v1,v2) = e[1:]
-        s1 = sets.find(v1)
-        s2 = sets.find(v2)
-        if s1 != s2:
-            regiontree.append(e)
-            sets.union(s1, s2)
-            adjacency[v1].append(v2)   # only necessary for ordering
-            adjacency[v2].append(v1)
+    (weights, id1, id2) = _edge_arrays(rg)
+    n = max_segid+1  # vertices are indexed by segment ID
+    index_type = 'int32' if max(n, len(weights)) < 2**31 else 'int64'
+    id1 = id1.astype(index_type)
+    id2 = id2.astype(index_type)
+
+    # Kruskal's algorithm, run as Boruvka rounds
+    component = numpy.arange(n, dtype=index_type)   # smallest segid of the component of every vertex
+    in_tree = numpy.zeros(len(weights), dtype=bool)
+    active = numpy.arange(len(weights), dtype=index_type)
+    while True:
+        (c1, c2) = (component[id1[active]], component[id2[active]])
+        joining = c1 != c2
+        (active, c1, c2) = (active[joining], c1[joining], c2[joining])
+        if len(active) == 0:
+            break
+        earliest = numpy.full(n, len(weights), dtype=index_type)
+        numpy.minimum.at(earliest, c1, active)
+        numpy.minimum.at(earliest, c2, active)
+        chosen = earliest[earliest < len(weights)]  # an edge may be chosen from both of its sides
+        in_tree[chosen] = True
+        roots = _components(n, component[id1[chosen]], component[id2[chosen]])
+        component = roots[component]
+    tree = numpy.flatnonzero(in_tree)
+    (weights, id1, id2) = (weights[tree], id1[tree], id2[tree])
 
     # rest of code only necessary for ordering the vertex pairs in each edge
-    # bfs (level order) tree traversal, i.e., topological sort
-    order = [0] * max_segid   # will contain numbering of vertices
-    curr = 1
-    for i in range(max_segid):
-        if order[i] == 0:
-            bfs = collections.deque()
-            bfs.append(i) #TODO check Python deque semantics. Append right, popleft() later?
-            order[i] = curr
-            curr += 1
-
-            while length(bfs)>0:
-                x = bfs.popleft()
-
-                for y in adjacency[x]:
-                    if order[y] == 0:
-                        order[y] = curr
-                        curr += 1
-                        bfs.append(y)
+    # bfs (level order) tree traversal from the root of every tree, recording the depth of each vertex
+    adjacency = numpy.argsort(numpy.concatenate((id1, id2)), kind='stable')    # CSR adjacency list
+    neighbors = numpy.concatenate((id2, id1))[adjacency]
+    first = numpy.zeros(n+1, dtype='int64')
+    numpy.cumsum(numpy.bincount(numpy.concatenate((id1, id2)), minlength=n), out=first[1:])
+    depth = numpy.full(n, -1, dtype=index_type)
+    frontier = numpy.flatnonzero(component == numpy.arange(n))[1:].astype(index_type)  # roots, skipping unused segid 0
+    level = 0
+    while len(frontier) > 0:
+        depth[frontier] = level
+        degree = first[frontier+1] - first[frontier]
+        slots = numpy.repeat(first[frontier] - (numpy.cumsum(degree) - degree), degree) + numpy.arange(degree.sum())
+        frontier = neighbors[slots]
+        frontier = frontier[depth[frontier] < 0]
+        level += 1
 
     # order all edges as (weight, parent, child)
-    for i in range(len(regiontree)):
-        e = regiontree[i]
-        if order[e[2]] > order[e[1]]:
-            regiontree[i] = (e[0], e[2], e[1])
+    swap = depth[id2] < depth[id1]
+    regiontree = RegionGraph.empty(len(tree), max_segid)
+    regiontree.weights[:] = weights
+    regiontree.id1[:] = numpy.where(swap, id2, id1)
+    regiontree.id2[:] = numpy.where(swap, id1, id2)
     return regiontree
 
+"""
+dendrogram of a region tree, for merging at many thresholds
+
+    hierarchy = MergeHierarchy(regiontree, max_segid)
+    relabel = hierarchy.roots(thd)
+
+Inputs:
+* `regiontree`: region tree from `mst`, a RegionGraph of (weight,parent,child) edges
+* `max_segid`: largest segment ID that will be looked up, if larger than the largest ID in the tree
+
+Merging at threshold `thd` joins every child to its parent when the weight of their edge is >= `thd`. `roots(thd)` is a
+relabel table that maps every segment ID to the ID of the tree root it ends up in, and `relabel(seg, hierarchy.roots(thd))` merges a
+segmentation. The table is computed by pointer jumping over the segment arrays, so trying a new threshold costs
+O(segments), independent of the size of the segmentation.
+"""
+class MergeHierarchy(object):
+
+    def __init__(self, regiontree, max_segid=None):
+        (weights, parents, children) = _edge_arrays(regiontree)
+        if len(weights) > 0:
+            max_segid = max(max_segid or 0, int(parents.max()), int(children.max()))
+        max_segid = max_segid or 0
+        self.parent = numpy.arange(max_segid+1, dtype=label_dtype(max_segid))   # parent of every segment, roots point to themselves
+        self.height = numpy.full(max_segid+1, -numpy.inf, dtype='float32')   # weight of the edge to the parent
+        self.parent[children] = parents
+        self.height[children] = weights
+
+    def merging(self, thd):
+        """Which segments are merged into their parent at threshold thd"""
+        return _exceeds(self.height, thd, inclusive=True)
+
+    def roots(self, thd):
+        """Relabel table mapping every segment ID to its root after merging edges with weight >= thd"""
+        relabel = numpy.where(self.merging(thd), self.parent, numpy.arange(len(self.parent), dtype=self.parent.dtype))
+        return _jump(relabel)
+
+    def sweep(self, thds):
+        """Yield (thd, relabel table) for each threshold in thds"""
+        for thd in thds:
+            yield thd, self.roots(thd)
+
+
+def _slab_edges(aff, seg, zs, packed):
+    """
+    Edge table of the voxel pairs whose second voxel lies in z-slab zs, including the pairs across the slab's lower
+    face: keys of the vertex pairs (i,j), i < j, each once and sorted, and the maximum affinity of each pair
+    """
+    first = max(zs.start - 1, 0) # the plane before the slab, for the pairs across its lower face
+    (seg, aff) = (seg[:, :, first:zs.stop], aff[:, :, first:zs.stop])
+    own = zs.start - first
+    if packed and _compiled(aff, seg):
+        (keys, weights) = numba_kernels.boundary_edges(numpy.asarray(aff), seg, own, _layout(seg) == 'F')
+    else:
+        keys = []
+        weights = []
+        for d in range(3):
+            (here, there, edge) = _shifted(d)  # the negative neighbor along axis d
+            # x and y pairs of the extra plane belong to the slab before; its z pairs are the ones across the face
+            (s, a) = (seg, aff) if d == 2 else (seg[:, :, own:], aff[:, :, own:])
+            (s1, s2) = (s[here], s[there])
+            boundary = (s1 != 0) & (s2 != 0) & (s1 != s2)  # background voxels (ID 0) are ignored
+            (s1, s2) = (s1[boundary].astype('uint64'), s2[boundary].astype('uint64'))
+            if packed:
+                keys.append((numpy.minimum(s1, s2) << numpy.uint64(32)) | numpy.maximum(s1, s2))
+            else:
+                keys.append(numpy.stack((numpy.minimum(s1, s2), numpy.maximum(s1, s2)), axis=1))
+            weights.append(_neighbor_affinity(a, d)[boundary])
+        keys = numpy.concatenate(keys)
+        weights = numpy.concatenate(weights)
+    return _max_edges(keys, weights, packed)
+
+def _max_edges(keys, weights, packed):
+    """Reduce an edge table to one entry per vertex pair, with the maximum of its weights, sorted by key"""
+    order = numpy.argsort(keys) if packed else numpy.lexsort((keys[:, 1], keys[:, 0]))
+    keys = keys[order]
+    weights = weights[order]
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1] if packed else numpy.any(keys[1:] != keys[:-1], axis=1)
+    first = numpy.flatnonzero(first)
+    if len(first) == 0:
+        return keys, weights
+    return keys[first], numpy.maximum.reduceat(weights, first)
 
 """
 create region graph by finding maximum affinity between each pair of regions in segmentation
@@ -334,7 +701,7 @@ Inputs:
 * `max_segid`: number of segments
 
 Returns:
-* `rg`: region graph as list of edges, array of (weight,id1,id2) tuples. The edges are sorted so that weights are in descending order.
+* `rg`: region graph as a RegionGraph, with columns `weights`, `id1` and `id2`. The edges are sorted so that weights are in descending order.
 
 The vertices of the region graph are regions in the segmentation.  An
 edge of the region graph corresponds to a pair of regions in the
@@ -346,44 +713,46 @@ The region graph includes every edge between a region and itself.
 The weight of a self-edge is the maximum affinity within the region.
 
 Background voxels (those with ID=0) are ignored.
+
+The volume is split into z-slabs that `workers` threads (by default one per CPU) process at the same time. Each
+slab reduces the voxel pairs whose second voxel it holds, including those across its lower face, to a partial table
+of (pair, maximum affinity); the partial tables are then merged by taking the maximum again for every pair.
 """
-def regiongraph(aff, seg, max_segid):
-    (xdim,ydim,zdim)=size(seg)
-    assert aff.shape() == (xdim,ydim,zdim,3)
+def regiongraph(aff, seg, max_segid, workers=None):
+    (xdim,ydim,zdim) = seg.shape
+    assert aff.shape == (xdim,ydim,zdim,3)
+    packed = max_segid < 2**32  # both IDs of an edge fit in one uint64 key, otherwise pairs are sorted as two columns
 
     low = 0.0  # choose a value lower than any affinity in the region graph
-    ZERO_SEG = 0
-
-    # edge list representation
-    edges = {}
-    # keys are vertex pairs (i,j) where i <= j
-    # values are edge weights
-
-    for z in range(zdim):
-        for y in range(ydim):
-            for x in range(xdim):
-                if seg[x,y,z] != ZERO_SEG:   # ignore background voxels
-                    if (x > 1) and seg[x-1,y,z] != ZERO_SEG and seg[x,y,z] != seg[x-1,y,z]:
-                        p = (min(seg[x,y,z], seg[x-1,y,z]), max(seg[x,y,z], seg[x-1,y,z])) 
-                        edges[p] = max(edges[p], aff[x,y,z,0])
-                    end
-                    if (y > 1) and seg[x,y-1,z] != ZERO_SEG and seg[x,y,z] != seg[x,y-1,z]:
-                        p = (min(seg[x,y,z], seg[x,y-1,z]), max(seg[x,y,z], seg[x,y-1,z]))
-                        edges[p] = max(edges[p], aff[x,y,z,1])
-                    end
-                    if (z > 1) and seg[x,y,z-1] != ZERO_SEG and seg[x,y,z] != seg[x,y,z-1]:
-                        p = (min(seg[x,y,z], seg[x,y,z-1]), max(seg[x,y,z], seg[x,y,z-1]))
-                        edges[p] = max(edges[p], aff[x,y,z,2])
-
-    # separate weights and vertices in two arrays
-    nedges = len(edges)
-    println("Region graph size: ", nedges)
-    # repackage in array of typles
-    rg = numpy.zeros(nedges, dtype='uint32, uint32, float32') 
-    i = 0
-    for (k,v) in edges:
-        i += 1
-        rg[i]= (v, k[0], k[1])
-    rg.sort(kind='mergesort') #TODO: Make sure this still sorts using the right key. Also why mergesort?
+
+    # edge tables: one entry per pair of regions that touch, with the largest affinity between them, in aff's units.
+    # keys are vertex pairs (i,j) where i < j, packed as (i << 32) | j, or stacked as rows of [i, j]
+    workers = workers or os.cpu_count() or 1
+    nslabs = max(min(workers, zdim, seg.size // REGIONGRAPH_SLAB_VOXELS), 1)
+    bounds = numpy.linspace(0, zdim, nslabs+1).astype(int)
+    slabs = [slice(start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:])]
+    if nslabs == 1:
+        (keys, weights) = _slab_edges(aff, seg, slabs[0], packed)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(nslabs) as pool:
+            tables = list(pool.map(lambda zs: _slab_edges(aff, seg, zs, packed), slabs))
+        (keys, weights) = _max_edges(numpy.concatenate([keys for (keys, weights) in tables]),
+                                     numpy.concatenate([weights for (keys, weights) in tables]), packed)
+        del tables
+    weights = numpy.maximum(weights, low)
+    if aff.dtype.kind != 'f': # quantized affinities
+        weights = weights * numpy.float32(affinity_scale(aff.dtype))
+
+    nedges = len(keys)
+    print("Region graph size: ", nedges)
+    # repackage as columns, sorted by descending weight. Equal weights keep ascending (id1,id2) order
+    order = nedges - 1 - numpy.argsort(weights[::-1], kind='stable')[::-1]
+    rg = RegionGraph.empty(nedges, max_segid)
+    rg.weights[:] = weights[order]
+    if packed:
+        rg.id1[:] = keys[order] >> numpy.uint64(32)
+        rg.id2[:] = keys[order] & numpy.uint64(0xffffffff)
+    else:
+        rg.ids[:] = keys[order]
     return rg
 
@@ -0,0 +1,88 @@
+"""
+Per-stage measurements for the watershed pipeline.
+
+A stage is wrapped in `measure(stage, voxels, callback)`. When it finishes, `callback` receives one record (a dict) with
+the stage name, wall and CPU seconds, peak resident memory of the process while the stage ran, voxel throughput, and
+any counts the stage added to the record (basins, region graph edges, merges). With no callback nothing is measured.
+
+`json_lines(stream)` is a callback that writes each record as one line of JSON, e.g. for a batch scheduler to pick up.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+
+def _current_rss():
+    """Resident set size of this process in bytes, or None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+class PeakRSS(object):
+    """Context manager that samples the resident memory of the process in a thread and records the peak in bytes"""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, _current_rss() or 0)
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        if _current_rss() is None: #Fall back to the lifetime peak of the process
+            self._thread = None
+        else:
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        if self._thread is None:
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        else:
+            self._thread.join()
+            self.peak = max(self.peak, _current_rss())
+        return False
+
+@contextlib.contextmanager
+def measure(stage, voxels, callback=None, **context):
+    """
+    Measure the stage run inside the `with` block and pass its record to `callback`. The block receives the record
+    and may add counts to it, or set `voxels` if it is only known inside; `context` (e.g. the block being segmented)
+    is copied into the record as is.
+    """
+    record = dict(context)
+    if callback is None:
+        yield record
+        return
+    with PeakRSS() as rss:
+        (wall, cpu) = (time.perf_counter(), time.process_time())
+        yield record
+        (wall, cpu) = (time.perf_counter() - wall, time.process_time() - cpu)
+    voxels = record.pop('voxels', voxels)
+    record.update({'stage': stage,
+                   'wall_seconds': wall,
+                   'cpu_seconds': cpu,
+                   'peak_rss_mb': rss.peak / 2.0**20,
+                   'voxels': int(voxels),
+                   'voxels_per_second': voxels / wall if wall > 0 else float('inf')})
+    callback(record)
+
+def json_lines(stream):
+    """Callback that writes every stage record to `stream` as one line of JSON"""
+    def callback(record):
+        stream.write(json.dumps(record, sort_keys=True) + '\n')
+        stream.flush()
+    return callback
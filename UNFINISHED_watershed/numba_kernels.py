@@ -0,0 +1,301 @@
+"""
+Compiled loops for the core watershed kernels, used by graph_functions when Numba is installed and the numba backend
+is selected (see graph_functions.set_backend). Each kernel returns exactly what its NumPy counterpart in
+graph_functions returns; `python benchmark.py --check_backends` compares the two.
+
+Importing this module raises ImportError when Numba is missing, which graph_functions takes as the signal to stay on
+the NumPy backend.
+"""
+
+import numpy
+import numba
+
+# Same encoding as graph_functions: directions -x, -y, -z, +x, +y, +z as (axis, step)
+DIR_AXIS = numpy.array([0, 1, 2, 0, 1, 2], dtype=numpy.int64)
+DIR_STEP = numpy.array([-1, -1, -1, 1, 1, 1], dtype=numpy.int64)
+DIR_MASK = numpy.array([0x01, 0x02, 0x04, 0x08, 0x10, 0x20], dtype=numpy.uint8)
+IDIR_MASK = numpy.array([0x08, 0x10, 0x20, 0x01, 0x02, 0x04], dtype=numpy.uint8)
+VISITED = 0x40
+ASSIGNED = 0x80000000 #Marks voxels of findbasins whose basin is known, as in Watershed.jl
+
+@numba.njit(cache=True)
+def _neighbor(shape, x, y, z, d):
+    """Coordinates of the neighbor of (x, y, z) in direction d, and whether it lies inside the volume"""
+    axis = DIR_AXIS[d]
+    step = DIR_STEP[d]
+    (nx, ny, nz) = (x + step if axis == 0 else x, y + step if axis == 1 else y, z + step if axis == 2 else z)
+    inside = 0 <= nx < shape[0] and 0 <= ny < shape[1] and 0 <= nz < shape[2]
+    return inside, nx, ny, nz
+
+@numba.njit(cache=True)
+def _affinity(aff, x, y, z, d):
+    """Affinity between (x, y, z) and its neighbor in direction d, which must exist"""
+    axis = DIR_AXIS[d]
+    if DIR_STEP[d] < 0:
+        return aff[x, y, z, axis]
+    if axis == 0:
+        return aff[x+1, y, z, 0]
+    if axis == 1:
+        return aff[x, y+1, z, 1]
+    return aff[x, y, z+1, 2]
+
+@numba.njit(cache=True)
+def _steepest_edges(aff, low, high, shape, x, y, z):
+    """Outgoing edges of (x, y, z) in the steepest ascent graph"""
+    found = False
+    m = aff[x, y, z, 0]
+    for d in range(6):
+        (inside, nx, ny, nz) = _neighbor(shape, x, y, z, d)
+        if inside:
+            a = _affinity(aff, x, y, z, d)
+            if not found or a > m:
+                (m, found) = (a, True)
+    if not found or not m > low:
+        return 0
+    edges = 0
+    for d in range(6):
+        (inside, nx, ny, nz) = _neighbor(shape, x, y, z, d)
+        if inside:
+            a = _affinity(aff, x, y, z, d)
+            if a == m or a >= high:
+                edges |= DIR_MASK[d]
+        elif low >= high: #A missing neighbor counts as `low`, which is >= high here
+            edges |= DIR_MASK[d]
+    return edges
+
+@numba.njit(cache=True)
+def steepestascent(aff, low, high, sag, fortran):
+    """
+    Steepest ascent graph of aff, written into the zeroed uint8 array sag; `low` and `high` are in the units of aff.
+    Voxels are visited in memory order: x fastest if `fortran` is set, z fastest otherwise
+    """
+    (xdim, ydim, zdim) = aff.shape[:3]
+    shape = (xdim, ydim, zdim)
+    if fortran:
+        for z in range(zdim):
+            for y in range(ydim):
+                for x in range(xdim):
+                    sag[x, y, z] = _steepest_edges(aff, low, high, shape, x, y, z)
+    else:
+        for x in range(xdim):
+            for y in range(ydim):
+                for z in range(zdim):
+                    sag[x, y, z] = _steepest_edges(aff, low, high, shape, x, y, z)
+    return sag
+
+@numba.njit(cache=True)
+def _last_bit(bits):
+    last = 0
+    for d in range(6):
+        if bits & DIR_MASK[d]:
+            last = DIR_MASK[d]
+    return last
+
+@numba.njit(cache=True)
+def _seed(sag, shape, x, y, z):
+    """
+    Keep the last exit of (x, y, z) if it has no plateau edge, or mark it as a BFS seed if it has both. Returns whether
+    (x, y, z) lies on a plateau, as only such voxels are ever queued
+    """
+    exits = 0
+    plateau = 0
+    for d in range(6):
+        if sag[x, y, z] & DIR_MASK[d]:
+            (inside, nx, ny, nz) = _neighbor(shape, x, y, z, d)
+            if inside:
+                if sag[nx, ny, nz] & IDIR_MASK[d]:
+                    plateau |= DIR_MASK[d]
+                else:
+                    exits |= DIR_MASK[d]
+    if exits != 0 and plateau == 0:
+        sag[x, y, z] = _last_bit(exits)
+    elif exits != 0:
+        sag[x, y, z] |= VISITED
+    return plateau != 0
+
+@numba.njit(cache=True)
+def divideplateaus(sag, fortran):
+    """
+    Divide plateaus of sag in place, one BFS level at a time like the NumPy version: the new edges of a level are
+    only written once the whole level has been examined, so a voxel never points at a voxel of its own level.
+    Seeds are found in memory order: x fastest if `fortran` is set, z fastest otherwise. The queue is sized by the
+    plateau voxels counted while finding them, like the NumPy version's
+    """
+    (xdim, ydim, zdim) = sag.shape
+    shape = (xdim, ydim, zdim)
+    plane = ydim * zdim
+    on_plateau = 0
+    if fortran:
+        for z in range(zdim):
+            for y in range(ydim):
+                for x in range(xdim):
+                    on_plateau += _seed(sag, shape, x, y, z)
+    else:
+        for x in range(xdim):
+            for y in range(ydim):
+                for z in range(zdim):
+                    on_plateau += _seed(sag, shape, x, y, z)
+    queue = numpy.empty(on_plateau, dtype=numpy.int32) #C-order flat indices, the backend only takes volumes below 2^31 voxels
+    to_set = numpy.empty(on_plateau, dtype=numpy.uint8)
+    tail = 0
+    if fortran:
+        for z in range(zdim):
+            for y in range(ydim):
+                for x in range(xdim):
+                    if sag[x, y, z] & VISITED:
+                        queue[tail] = (x * ydim + y) * zdim + z
+                        tail += 1
+    else:
+        for x in range(xdim):
+            for y in range(ydim):
+                for z in range(zdim):
+                    if sag[x, y, z] & VISITED:
+                        queue[tail] = (x * ydim + y) * zdim + z
+                        tail += 1
+
+    head = 0
+    while head < tail:
+        end = tail
+        for i in range(head, tail):
+            (x, y, z) = (queue[i] // plane, (queue[i] // zdim) % ydim, queue[i] % zdim)
+            edge = 0
+            for d in range(6):
+                if sag[x, y, z] & DIR_MASK[d]:
+                    (inside, nx, ny, nz) = _neighbor(shape, x, y, z, d)
+                    if not inside:
+                        continue
+                    if sag[nx, ny, nz] & IDIR_MASK[d]:
+                        if (sag[nx, ny, nz] & VISITED) == 0:
+                            sag[nx, ny, nz] |= VISITED
+                            queue[end] = (nx * ydim + ny) * zdim + nz
+                            end += 1
+                    else:
+                        edge = DIR_MASK[d]
+            to_set[i] = edge
+        for i in range(head, tail):
+            (x, y, z) = (queue[i] // plane, (queue[i] // zdim) % ydim, queue[i] % zdim)
+            sag[x, y, z] = to_set[i]
+        (head, tail) = (tail, end)
+    return sag
+
+@numba.njit(cache=True)
+def _flat_neighbor(shape, strides, me, d):
+    """Flat index of the neighbor of flat index `me` in direction d, or -1 outside the volume"""
+    axis = DIR_AXIS[d]
+    coord = (me // strides[axis]) % shape[axis] + DIR_STEP[d]
+    if coord < 0 or coord >= shape[axis]:
+        return -1
+    return me + DIR_STEP[d] * strides[axis]
+
+@numba.njit(cache=True)
+def findbasins(sag, shape, strides):
+    """
+    Basins of sag, given flat in memory order with the `shape` and `strides` (in voxels) of the volume. Voxels are
+    visited in memory order as in Watershed.jl: a BFS along outgoing edges either reaches a voxel whose basin is known
+    and joins it, or exhausts a new basin. Returns the flat seg (uint32), counts and counts0.
+    """
+    seg = sag.astype(numpy.uint32)
+    queue = numpy.empty(sag.size, dtype=numpy.int64)
+    counts = numpy.zeros(16, dtype=numpy.int64)
+    counts0 = 0
+    next_id = 1
+    for start in range(sag.size):
+        if seg[start] == 0:
+            seg[start] = ASSIGNED
+            counts0 += 1
+            continue
+        if seg[start] & ASSIGNED:
+            continue
+        seg[start] |= VISITED
+        queue[0] = start
+        (head, tail) = (0, 1)
+        basin = 0
+        while head < tail and basin == 0:
+            me = queue[head]
+            for d in range(6):
+                if (seg[me] & DIR_MASK[d]) == 0:
+                    continue
+                there = _flat_neighbor(shape, strides, me, d)
+                if there < 0 or sag[there] == 0: #Edges into the background lead nowhere
+                    continue
+                if seg[there] & ASSIGNED:
+                    basin = seg[there]
+                    break
+                if (seg[there] & VISITED) == 0:
+                    seg[there] |= VISITED
+                    queue[tail] = there
+                    tail += 1
+            head += 1
+        if basin == 0: #A new basin
+            basin = ASSIGNED | next_id
+            if next_id > len(counts):
+                counts = numpy.concatenate((counts, numpy.zeros(len(counts), dtype=numpy.int64)))
+            next_id += 1
+        counts[(basin & ~ASSIGNED) - 1] += tail
+        for i in range(tail):
+            seg[queue[i]] = basin
+    for i in range(seg.size):
+        seg[i] &= ~ASSIGNED
+    return seg, counts[:next_id-1], counts0
+
+@numba.njit(cache=True, nogil=True)
+def _pair_edges(aff, seg, x, y, z, keys, weights, n, count_only):
+    """
+    Record the pairs between (x, y, z) and its negative neighbors in other foreground segments at keys[n:] and
+    weights[n:], unless count_only is set. Returns n plus the number of such pairs
+    """
+    s1 = numpy.uint64(seg[x, y, z])
+    if s1 == 0:
+        return n
+    for axis in range(3):
+        if axis == 0:
+            if x == 0:
+                continue
+            s2 = numpy.uint64(seg[x-1, y, z])
+        elif axis == 1:
+            if y == 0:
+                continue
+            s2 = numpy.uint64(seg[x, y-1, z])
+        else:
+            if z == 0:
+                continue
+            s2 = numpy.uint64(seg[x, y, z-1])
+        if s2 == 0 or s2 == s1:
+            continue
+        if not count_only:
+            keys[n] = (min(s1, s2) << numpy.uint64(32)) | max(s1, s2)
+            weights[n] = aff[x, y, z, axis]
+        n += 1
+    return n
+
+@numba.njit(cache=True, nogil=True)
+def _scan_pairs(aff, seg, zfirst, fortran, keys, weights, count_only):
+    """Pass of boundary_edges over the voxels with z >= zfirst in memory order, x fastest if `fortran` is set"""
+    (xdim, ydim, zdim) = seg.shape
+    n = 0
+    if fortran:
+        for z in range(zfirst, zdim):
+            for y in range(ydim):
+                for x in range(xdim):
+                    n = _pair_edges(aff, seg, x, y, z, keys, weights, n, count_only)
+    else:
+        for x in range(xdim):
+            for y in range(ydim):
+                for z in range(zfirst, zdim):
+                    n = _pair_edges(aff, seg, x, y, z, keys, weights, n, count_only)
+    return n
+
+@numba.njit(cache=True, nogil=True)
+def boundary_edges(aff, seg, zfirst, fortran):
+    """
+    Packed (min << 32) | max keys and affinities of every pair of face-adjacent voxels in different foreground
+    segments whose second voxel has z >= zfirst, in one pass over the volume in memory order after a counting pass.
+    Runs without the GIL, so regiongraph can run it on several z-slabs at once
+    """
+    keys = numpy.empty(0, dtype=numpy.uint64)
+    weights = numpy.empty(0, dtype=aff.dtype)
+    total = _scan_pairs(aff, seg, zfirst, fortran, keys, weights, True)
+    keys = numpy.empty(total, dtype=numpy.uint64)
+    weights = numpy.empty(total, dtype=aff.dtype)
+    _scan_pairs(aff, seg, zfirst, fortran, keys, weights, False)
+    return keys, weights
@@ -1,8 +1,16 @@
-import sys
+import argparse
+import itertools
+import importlib
+import multiprocessing
+from multiprocessing import shared_memory
 import h5py
 import numpy
 import data_utils
 from graph_functions import *
+from instrumentation import measure, json_lines
+from basin_cache import BasinCache, DEFAULT_CACHE_BYTES
+
+DisjointSets = importlib.import_module("disjoint-sets").DisjointSets
 
 DEFAULT_LOW = 0.1
 DEFAULT_HIGH = 0.8
@@ -10,6 +18,12 @@ DEFAULT_DUST_SIZE = 600
 DEFAULT_MERGE_SIZE = 800
 DEFAULT_MERGE_THRESHOLD = 0.2
 DEFAULT_THRESHOLD_RELATIVE = True
+DEFAULT_HALO = 16 #Voxels of context added on every side of a block in blockwise mode
+DEFAULT_HISTOGRAM_ERROR = 1e-6 #Largest error of an absolute threshold derived from a relative one
+DEFAULT_SLAB_BYTES = 256*1024*1024 #Size of the z-slabs streamed from HDF5 datasets
+DEFAULT_COMPRESSION = 'gzip' #Filter for the output dataset: 'gzip', 'lzf' or None
+DEFAULT_STATS_SLAB_BYTES = DEFAULT_SLAB_BYTES // 8 #Labels per slab of segmentstats, which also holds their coordinates
+SEGMENT_STATS = ('count', 'bbox_min', 'bbox_max', 'centroid', 'max_affinity')
 
 class Thresholds:
     input_path = ""
@@ -19,135 +33,605 @@ class Thresholds:
     merge_size = DEFAULT_MERGE_SIZE
     dust_size = DEFAULT_DUST_SIZE
     is_threshold_relative = DEFAULT_THRESHOLD_RELATIVE
+    block_shape = None #Segment block by block when set, see blockseg
+    halo = DEFAULT_HALO
+    histogram_error = DEFAULT_HISTOGRAM_ERROR
+    chunks = None #Chunk shape of the output dataset. Blockwise mode defaults to the block shape, otherwise h5py picks one
+    compression = DEFAULT_COMPRESSION
+    compression_level = None #gzip level 0-9, h5py's default when None
+    affinity_dtype = None #Convert affinities to 'float16' or quantize them to 'uint8' as they are read
+    low_memory = False #Memory-map the affinities instead of reading them, where the input allows it
+    cache_dir = None #Directory of the basin cache, see basin_cache.BasinCache. No caching when None
+    cache_size = DEFAULT_CACHE_BYTES
+    statistics = True #Store segmentstats of the output in its 'segments' group
+    workers = None #Threads building the region graph, one per CPU when None
+
+def percent2thd(hist, rt):
+    """Affinity threshold below which a fraction `rt` of the voxels of a (counts, bin_edges) histogram lie"""
+    (counts, edges) = hist
+    rank = numpy.sum(counts) * rt
+    i = numpy.searchsorted(numpy.cumsum(counts), rank)
+    return edges[min(i, len(counts)-1)]
+
+def _slabs(data, slab_bytes=DEFAULT_SLAB_BYTES):
+    """Slices along z that split an (x, y, z, ...) array or HDF5 dataset into slabs of about slab_bytes"""
+    plane_bytes = max(data.dtype.itemsize * int(numpy.prod(data.shape)) // max(data.shape[2], 1), 1)
+    step = max(slab_bytes // plane_bytes, 1)
+    chunks = getattr(data, 'chunks', None)
+    if chunks: #Read whole HDF5 chunks only
+        step = max(step // chunks[2], 1) * chunks[2]
+    for z in range(0, data.shape[2], step):
+        yield slice(z, min(z+step, data.shape[2]))
+
+def read_slabs(dataset, dtype=None):
+    """
+    Read a whole HDF5 dataset (or memmap) into memory one z-slab at a time, straight into the returned array. With `dtype`,
+    affinities are converted slab by slab with convert_affinities, so the full volume only exists in the new dtype.
+    """
+    if dtype is None or numpy.dtype(dtype) == dataset.dtype:
+        data = numpy.empty(dataset.shape, dtype=dataset.dtype)
+        for zs in _slabs(dataset):
+            selection = numpy.s_[:, :, zs]
+            dataset.read_direct(data, selection, selection)
+        return data
+    data = numpy.empty(dataset.shape, dtype=dtype)
+    for zs in _slabs(dataset):
+        data[:, :, zs] = convert_affinities(dataset[:, :, zs], dtype)
+    return data
+
+def convert_affinities(aff, dtype):
+    """
+    Affinities in another dtype: float16, or uint8 quantized so that a value q stands for the affinity q/255 (see
+    graph_functions.affinity_scale). Returns aff itself if it already has the dtype or dtype is None
+    """
+    if dtype is None or aff.dtype == numpy.dtype(dtype):
+        return aff
+    dtype = numpy.dtype(dtype)
+    if aff.dtype.kind != 'f': #Back to affinity units before converting again
+        aff = aff * affinity_scale(aff.dtype)
+    if dtype.kind != 'f':
+        return numpy.rint(numpy.clip(aff, 0.0, 1.0) / affinity_scale(dtype)).astype(dtype)
+    return aff.astype(dtype)
+
+def open_affinities(path, dtype=None, mmap=False):
+    """
+    The affinities in `path`, an HDF5 file with a `main` dataset or an .npy file, converted to `dtype` if given. With
+    `mmap`, an .npy file or an uncompressed, contiguous HDF5 dataset already in that dtype is opened as a read-only
+    numpy.memmap, so pages are only read as the pipeline touches them; anything else is read one slab at a time.
+    """
+    if path.endswith('.npy'):
+        aff = numpy.load(path, mmap_mode='r')
+        if dtype is None or aff.dtype == numpy.dtype(dtype):
+            return aff if mmap else numpy.array(aff)
+        return read_slabs(aff, dtype)
+    with h5py.File(path, 'r') as h5file:
+        dataset = h5file["main"]
+        offset = dataset.id.get_offset()
+        in_place = dtype is None or dataset.dtype == numpy.dtype(dtype)
+        if mmap and in_place and offset is not None and dataset.chunks is None and dataset.compression is None:
+            return numpy.memmap(path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+        return read_slabs(dataset, dtype)
+
+def write_slabs(dataset, data):
+    """Write an in-memory volume into an HDF5 dataset of the same shape one z-slab at a time"""
+    for zs in _slabs(data):
+        dataset[:, :, zs] = data[:, :, zs]
 
-def relative2absolute(aff, low, high, thresholds):
-    if numpy.ma.size(aff) > 3*1024*1024*128:
-        hist = numpy.histogram(aff[1:min(1024, numpy.ma.size(aff, 1)),
-                                   1:min(1024, numpy.ma.size(aff, 2)),
-                                   1:min(128,  numpy.ma.size(aff, 3)),
-                                    :], nbins=10000000)
+def create_output(out_file, shape, thresh, dtype='uint32'):
+    """
+    Create the chunked and compressed `main` segmentation dataset of out_file. Its dtype should be the label_dtype of
+    the segmentation, uint32 unless there are 2^32 IDs or more
+    """
+    chunks = thresh.chunks
+    if chunks is None and thresh.block_shape is not None:
+        chunks = thresh.block_shape
+    if chunks is None:
+        chunks = True #Let h5py pick a chunk shape
     else:
-        hist = numpy.histogram(aff, nbins=1000000)
-    low = percent2thd(h, low)
-    high = percent2thd(h, high)
-    for i in range(len(thresholds)):
-        thresholds[i] = (thresholds[i][0], percent2thd(h, thresholds[i][1]))
+        chunks = tuple(min(c, dim) for (c, dim) in zip(chunks, shape))
+    compression_opts = thresh.compression_level if thresh.compression == 'gzip' else None
+    return out_file.create_dataset('main', shape, dtype=dtype, chunks=chunks,
+                                   compression=thresh.compression, compression_opts=compression_opts)
+
+def affinity_histogram(aff, error=DEFAULT_HISTOGRAM_ERROR, value_range=None):
+    """
+    Histogram (counts, bin_edges) of all affinities in aff, a 4D array or HDF5 dataset, accumulated one z-slab at a
+    time so that only a slab is in memory. Bins are `error` wide, so a percentile read from the histogram is within
+    `error` of the exact one. Finding the value range takes an extra pass over aff unless it is given.
+    Quantized affinities get one bin per value, which is exact; their bin edges are returned in affinity units.
+    """
+    if value_range is None:
+        (lo, hi) = (numpy.inf, -numpy.inf)
+        for zs in _slabs(aff):
+            slab = aff[:, :, zs, :]
+            (lo, hi) = (min(lo, slab.min()), max(hi, slab.max()))
+    else:
+        (lo, hi) = value_range
+    (lo, hi) = (float(lo), float(hi))
+    quantized = aff.dtype.kind != 'f'
+    width = 1.0 if quantized else error
+    nbins = max(int(numpy.ceil((hi - lo) / width)) + int(quantized), 1)
+    counts = numpy.zeros(nbins, dtype='int64')
+    edges = None
+    for zs in _slabs(aff):
+        slab = aff[:, :, zs, :]
+        slab = slab.astype(numpy.promote_types(slab.dtype, numpy.float32), copy=False) #Bin edges use the data dtype
+        (slab_counts, edges) = numpy.histogram(slab, bins=nbins, range=(lo, lo + nbins*width))
+        counts += slab_counts
+    if quantized:
+        edges = edges * affinity_scale(aff.dtype)
+    return counts, edges
+
+def relative2absolute(aff, low, high, thresholds, error=DEFAULT_HISTOGRAM_ERROR):
+    hist = affinity_histogram(aff, error)
+    low = percent2thd(hist, low)
+    high = percent2thd(hist, high)
+    thresholds = [(size_th, percent2thd(hist, weight_th)) for (size_th, weight_th) in thresholds]
     return low, high, thresholds
     
 
-def baseseg(aff, low_thresh, high_thresh, thresholds, dust_size, is_relative)
-    if is_relative:
-        low_thresh, high_thresh, thresholds = relative2absolute(aff, low, high, thresholds)
+def _basins(aff, low_thresh, high_thresh, voxels, callback, context, workers=None):
+    """The stages of baseseg that only depend on the affinities and the absolute low and high thresholds"""
     print("Steepest Ascent")
-    seg = steepestascent(aff, low, high)
+    with measure("steepestascent", voxels, callback, **context):
+        seg = steepestascent(aff, low_thresh, high_thresh)
     print("Divide Plateaus")
-    seg = divideplateaus(seg)
+    with measure("divideplateaus", voxels, callback, **context):
+        seg = divideplateaus(seg)
     print("Find Basins")
-    seg, counts, counts0 = findbasins(seg)
+    with measure("findbasins", voxels, callback, **context) as record:
+        seg, counts, counts0 = findbasins(seg)
+        record.update(basins=len(counts), background_voxels=int(counts0))
     print("Region Graph")
-    rg = regiongraph(aff, seg, len(counts))
+    with measure("regiongraph", voxels, callback, **context) as record:
+        rg = regiongraph(aff, seg, len(counts), workers)
+        record.update(rg_edges=len(rg))
+    return seg, counts, rg
+
+def baseseg(aff, low_thresh, high_thresh, thresholds, dust_size, is_relative, callback=None, cache=None, workers=None,
+            **context):
+    """
+    Steepest ascent, plateau division, basin labelling, region graph and region merging on one affinity volume.
+    If `callback` is given, it receives a record per stage with timings, peak memory, throughput and the stage's counts,
+    see instrumentation.measure; `context` is added to every record. With a basin_cache.BasinCache as `cache`, the
+    stages before region merging are skipped when their results for these affinities, low and high are cached.
+    `workers` threads build the region graph, see graph_functions.regiongraph.
+    """
+    voxels = numpy.prod(aff.shape[:3])
+    if is_relative:
+        with measure("relative2absolute", voxels, callback, **context):
+            low_thresh, high_thresh, thresholds = relative2absolute(aff, low_thresh, high_thresh, thresholds)
+    cached = None
+    if cache is not None:
+        with measure("cache", voxels, callback, **context) as record:
+            key = cache.key(aff, low_thresh, high_thresh)
+            cached = cache.load(key)
+            record.update(hit=cached is not None)
+    if cached is not None:
+        print("Basins and region graph loaded from cache")
+        seg, counts, rg = cached
+    else:
+        seg, counts, rg = _basins(aff, low_thresh, high_thresh, voxels, callback, context, workers)
+        if cache is not None:
+            cache.store(key, seg, counts, rg)
     print("Merge Regions")
-    new_rg = mergeregions(seg, rg, counts, thresholds, dust_size)
+    with measure("mergeregions", voxels, callback, **context) as record:
+        thresholds = [(size_th, weight_threshold(weight_th, aff.dtype)) for (size_th, weight_th) in thresholds]
+        new_rg, counts = mergeregions(seg, rg, counts, thresholds, dust_size, record)
+        record.update(regions=len(counts), rg_edges=len(new_rg))
     return seg, new_rg, counts
 
-def atomicseg(thresh):
+def atomicseg(thresh, callback=None):
+    with measure("read", 0, callback) as record:
+        aff = open_affinities(thresh.input_path, thresh.affinity_dtype, thresh.low_memory)
+        voxels = numpy.prod(aff.shape[:3])
+        record.update(voxels=voxels, memmap=isinstance(aff, numpy.memmap), dtype=str(aff.dtype))
+    low, high, thresholds = (thresh.low_threshold, thresh.high_threshold, [(thresh.merge_size, thresh.merge_threshold)])
+    if thresh.is_threshold_relative:
+        with measure("relative2absolute", voxels, callback):
+            low, high, thresholds = relative2absolute(aff, low, high, thresholds, thresh.histogram_error)
+    seg, rg, counts = baseseg(aff, low, high, thresholds, thresh.dust_size, False, callback, _cache(thresh),
+                              thresh.workers)
+    return seg
+
+def _cache(thresh):
+    """The basin cache configured in thresh, if any"""
+    return BasinCache(thresh.cache_dir, thresh.cache_size) if thresh.cache_dir is not None else None
+
+def _blocks(shape, block_shape):
+    """Tuples of slices tiling a volume of the given shape with blocks of (at most) block_shape"""
+    ranges = [range(0, dim, step) for (dim, step) in zip(shape, block_shape)]
+    for (z, y, x) in itertools.product(*reversed(ranges)):
+        yield tuple(slice(start, min(start+step, dim)) for (start, step, dim) in zip((x, y, z), block_shape, shape))
+
+def _matches(ours, theirs):
+    """
+    Pairs of labels (ours[i], theirs[i]) that are each other's best match, i.e. share more voxels with each other
+    than with any other label. Both inputs are the foreground labels of the same voxels in two segmentations.
+    """
+    (pairs, overlap) = numpy.unique(numpy.stack((ours, theirs), axis=1), axis=0, return_counts=True)
+    order = numpy.argsort(-overlap, kind='stable')
+    pairs = pairs[order]
+    best_ours = numpy.unique(pairs[:, 0], return_index=True)[1]    # first (largest) overlap of each of our labels
+    best_theirs = numpy.unique(pairs[:, 1], return_index=True)[1]
+    return pairs[numpy.intersect1d(best_ours, best_theirs)]
+
+def blockseg(thresh, out_dataset, callback=None):
+    """
+    Segment the `main` affinity dataset of `thresh.input_path` one block at a time and write the result into
+    `out_dataset`, an HDF5 dataset of the volume's shape. Only one block of `thresh.block_shape` voxels plus
+    `thresh.halo` voxels of context on each side is held in memory at a time.
+
+    Each block is segmented with baseseg. Its segments that reach the block's core, or match a written segment under
+    its halo, get IDs that do not collide with earlier blocks, so temporary IDs only grow with the segments actually
+    kept; an OverflowError is raised if they no longer fit in out_dataset. Where its halo overlaps
+    blocks already written, segments that are each other's best match are stitched together; a final pass over the
+    output relabels the stitched segments and renumbers the IDs in the output consecutively. Stage records passed to
+    `callback` carry the `block` they were measured on.
+    """
     h5file = h5py.File(thresh.input_path, 'r')
     raw_data = h5file.get("main")
-    aff = numpy.array(raw_data)
+    shape = raw_data.shape[:3]
+    low, high, thresholds = (thresh.low_threshold, thresh.high_threshold, [(thresh.merge_size, thresh.merge_threshold)])
+    if thresh.is_threshold_relative: #Thresholds must agree between blocks, so derive them once for the whole volume
+        with measure("relative2absolute", numpy.prod(shape), callback):
+            low, high, thresholds = relative2absolute(raw_data, low, high, thresholds, thresh.histogram_error)
+
+    cache = _cache(thresh)
+    next_id = 1
+    stitched = []
+    written_ids = [numpy.zeros(1, dtype=out_dataset.dtype)] # background is always kept
+    for core in _blocks(shape, thresh.block_shape):
+        outer = tuple(slice(max(s.start-thresh.halo, 0), min(s.stop+thresh.halo, dim)) for (s, dim) in zip(core, shape))
+        inner = tuple(slice(s.start-o.start, s.stop-o.start) for (s, o) in zip(core, outer))
+        block = [(s.start, s.stop) for s in core]
+        print("Block " + str(block))
+        aff = convert_affinities(raw_data[outer + (slice(None),)], thresh.affinity_dtype)
+        seg, rg, counts = baseseg(aff, low, high, thresholds, thresh.dust_size, False, callback, cache,
+                                  thresh.workers, block=block)
+        del aff
+
+        # Match to the blocks already written under the halo. Unwritten voxels read as background and are skipped
+        written = out_dataset[outer]
+        halo = numpy.ones(seg.shape, dtype=bool)
+        halo[inner] = False
+        shared = halo & (seg != 0) & (written != 0)
+        matches = _matches(seg[shared], written[shared]) if numpy.any(shared) else numpy.zeros((0, 2), dtype=seg.dtype)
+
+        # Give the segments that are written or matched the next free IDs
+        kept = numpy.union1d(numpy.unique(seg[inner]), matches[:, 0])
+        kept = kept[kept != 0]
+        if next_id + len(kept) - 1 > numpy.iinfo(out_dataset.dtype).max:
+            raise OverflowError("More segments than " + str(out_dataset.dtype) + " output IDs can hold")
+        lookup = numpy.zeros(len(counts)+1, dtype=out_dataset.dtype)
+        lookup[kept] = numpy.arange(next_id, next_id + len(kept), dtype=out_dataset.dtype)
+        next_id += len(kept)
+        seg = numpy.take(lookup, seg)
+        if len(matches) > 0:
+            stitched.append(numpy.stack((lookup[matches[:, 0]], matches[:, 1].astype(out_dataset.dtype)), axis=1))
+        out_dataset[core] = seg[inner]
+        written_ids.append(numpy.unique(seg[inner]))
     h5file.close()
-    seg, rg, counts = baseseg(aff, thresh.low_threshold, thresh.high_threshold, 
-                                [(thresh.merge_size, thresh.merge_threshold)], 
-                                thresh.dust_size, thresh.is_threshold_relative)
-    return seg
+
+    # Resolve stitched pairs into one label per segment, then renumber consecutively over the whole output
+    sets = DisjointSets(next_id)
+    if stitched:
+        stitched = numpy.concatenate(stitched)
+        sets.union_many(stitched[:, 0], stitched[:, 1])
+    roots = sets.flatten()
+    written_ids = numpy.unique(numpy.concatenate(written_ids)) # segments seen only in halos never reach the output
+    # name every segment after its smallest written ID, so the numbering does not depend on the roots union-find picks
+    smallest = numpy.full(next_id, next_id, dtype='int64')
+    numpy.minimum.at(smallest, roots[written_ids], written_ids)
+    remaps = numpy.zeros(next_id, dtype=out_dataset.dtype)
+    remaps[written_ids] = numpy.unique(smallest[roots[written_ids]], return_inverse=True)[1] # 0 stays background
+    for core in _blocks(shape, thresh.block_shape):
+        out_dataset[core] = relabel(out_dataset[core], remaps)
+    print("Done with stitching, total: ", str(remaps.max()), " regions")
 
 def watershed(aff, low=DEFAULT_LOW, high=DEFAULT_HIGH, thresholds=[(DEFAULT_MERGE_SIZE, DEFAULT_MERGE_THRESHOLD)], 
-              dust_size=DEFAULT_DUST_SIZE, is_threshold_relative=DEFAULT_IS_THRESHOLD_RELATIVE):
-    seg, rg, counts = baseseg(aff, low, high, thresholds, dust_size, is_threshold_relative)
-    return seg
+              dust_size=DEFAULT_DUST_SIZE, is_threshold_relative=DEFAULT_THRESHOLD_RELATIVE, callback=None):
+    seg, rg, counts = baseseg(aff, low, high, thresholds, dust_size, is_threshold_relative, callback)
+    with measure("mst", numpy.prod(aff.shape[:3]), callback) as record:
+        rt = mst(rg, len(counts))
+        record.update(rg_edges=len(rt))
+    return seg, rt
 
 
-def mergerg(seg, rg, thd=0.5):
-    pd = {}
-    num = 0
-    for (a,c,p) in rg: #affinity, child, parent
-        assert (c>0 and p>0)
-        if a >= thd:
-            num += 1
-        pd[c] = (p,a)
-    print("Total number of merging edges: " + str(num))
-    print("Total number: " + str(numpy.ma.size(rg)))
-    
-    rd = {}
-    rset = set()
-    for (a, c0, p0) in rg:  
-        c = c0
-        p = p0
-        while (a>=thd and p in pd):
-            a = pd[p][1]
-            p = pd[p][0]
-        if p != p0:
-            rd[c0] = p
-            rset.add(P)
-    print("Number of trees: " + str(len(rset)))
-
-    num = 0
-    flat_seg = numpy.ravel(seg, 'F')
-    flat_seg_len = len(flat_seg)
+def mergerg(seg, rg, thd=0.5, hierarchy=None):
+    """
+    Merge the segments of seg (in place) along the edges of the region tree rg with affinity >= thd. Pass a
+    MergeHierarchy of rg as `hierarchy` to reuse it across thresholds.
+    """
+    if hierarchy is None:
+        hierarchy = MergeHierarchy(rg, max(int(seg.max()), 0))
+    merging = hierarchy.merging(thd)
+    print("Total number of merging edges: " + str(numpy.count_nonzero(merging)))
+    print("Total number: " + str(len(rg)))
+
+    roots = hierarchy.roots(thd)
+    print("Number of trees: " + str(len(numpy.unique(roots[merging]))))
+
     # set the segment id as relative root id
-    for i in range(flat_seg_len):
-        # segment id
-        sid = flat_seg[i]
-        if sid in rd:
-            flat_seg[i] = rd[sid]
-            num = num + 1
+    moved = roots != numpy.arange(len(roots))
+    num = sum(numpy.count_nonzero(moved[seg[:, :, zs]]) for zs in _slabs(seg)) # one slab of temporaries at a time
+    relabel(seg, roots)
     print("Really merged edges: " + str(num))
+    return seg
+
+def _wsseg2d_slice(affs, z, low, high, thresholds, dust_size, thd_rt):
+    """Segmentation of z-slice z of affs, as an (x, y, 1) array"""
+    seg, rt = watershed(affs[:,:,z:z+1,:], low, high, thresholds, dust_size)
+    return mergerg(seg, rt, weight_threshold(thd_rt, affs.dtype, inclusive=True))
+
+_shared_slices = {} #Shared memory attached by each wsseg2d worker process
+
+def _attach_shared_slices(affs_name, shape, dtype):
+    affs_shm = shared_memory.SharedMemory(name=affs_name)
+    _shared_slices['affs_shm'] = affs_shm
+    _shared_slices['affs'] = numpy.ndarray(shape, dtype=dtype, buffer=affs_shm.buf)
+
+def _wsseg2d_shared_slice(job):
+    """Segment one slice of the shared affinities. The slice comes back as a small array, not the affinities"""
+    (seg_name, z, params) = job
+    seg_shm = shared_memory.SharedMemory(name=seg_name)
+    seg = numpy.ndarray(_shared_slices['affs'].shape[:3], dtype='uint32', buffer=seg_shm.buf)
+    seg[:,:,z:z+1] = _wsseg2d_slice(_shared_slices['affs'], z, *params)
+    maxid = int(seg[:,:,z].max())
+    del seg
+    seg_shm.close()
+    return maxid
 
-def wsseg2d(affs, low=0.3, high=0.9, thresholds=[(256,0.3)], dust_size=100, thd_rt=0.5)
-    seg = numpy.zeros(size(affs)[:3], dtype='uint32')
-    for z in range(numpy.ma.size(affs,2)):
-        seg[:,:,z], rg = watershed(affs[:,:,z,:], low, high, thresholds, dust_size)
-        seg[:,:,z] = mergerg(seg[:,:,z], rg, thd_rg)
+def wsseg2d(affs, low=0.3, high=0.9, thresholds=[(256,0.3)], dust_size=100, thd_rt=0.5, processes=1):
+    """
+    Segment each z-slice of affs independently. With processes > 1 the slices are spread over a process pool: the
+    affinities are copied once into shared memory that every worker maps, and each worker writes its slice straight
+    into a shared segmentation buffer. Slice IDs are offset so that labels are unique across the whole volume.
+    """
+    seg = numpy.zeros(affs.shape[:3], dtype='uint32')
+    zdim = affs.shape[2]
+    params = (low, high, thresholds, dust_size, thd_rt)
+    if processes == 1:
+        maxids = []
+        for z in range(zdim):
+            seg[:,:,z:z+1] = _wsseg2d_slice(affs, z, *params)
+            maxids.append(int(seg[:,:,z].max()))
+    else:
+        affs_shm = shared_memory.SharedMemory(create=True, size=max(affs.nbytes, 1))
+        seg_shm = shared_memory.SharedMemory(create=True, size=max(seg.nbytes, 1))
+        try:
+            shared_affs = numpy.ndarray(affs.shape, dtype=affs.dtype, buffer=affs_shm.buf)
+            shared_affs[...] = affs
+            shared_seg = numpy.ndarray(seg.shape, dtype=seg.dtype, buffer=seg_shm.buf)
+            with multiprocessing.Pool(processes, initializer=_attach_shared_slices,
+                                      initargs=(affs_shm.name, affs.shape, affs.dtype.str)) as pool:
+                maxids = pool.map(_wsseg2d_shared_slice, [(seg_shm.name, z, params) for z in range(zdim)], chunksize=1)
+            seg[...] = shared_seg
+            del shared_affs, shared_seg
+        finally:
+            affs_shm.close()
+            affs_shm.unlink()
+            seg_shm.close()
+            seg_shm.unlink()
+
+    offsets = numpy.cumsum([0] + maxids[:-1])
+    if zdim > 0 and offsets[-1] + maxids[-1] > numpy.iinfo(seg.dtype).max:
+        raise OverflowError("More segments than " + str(seg.dtype) + " output IDs can hold")
+    for z in range(zdim):
+        numpy.add(seg[:,:,z], offsets[z], out=seg[:,:,z], where=seg[:,:,z] != 0, casting='unsafe')
     return seg
 
-def wsseg(affs, dim=3, low=0.3, high=0.9, thresholds=[(256,0.3)], dust_size=100, thd_rg=0.5)
+def wsseg(affs, dim=3, low=0.3, high=0.9, thresholds=[(256,0.3)], dust_size=100, thd_rg=0.5, processes=1):
     assert (dim==2 or dim==3)
     if dim==2:
-        return wsseg2d(affs, low, high, thresholds, dust_size, thd_rg)
+        return wsseg2d(affs, low, high, thresholds, dust_size, thd_rg, processes)
     else:
         seg, rg = watershed(affs, low, high, thresholds, dust_size)
-        seg = mergerg(seg, rg, thd_rg)
+        seg = mergerg(seg, rg, weight_threshold(thd_rg, affs.dtype, inclusive=True))
         return seg
 
 def rg2segmentpairs(rg):
-    flat_rg = numpy.ravel(rg, 'F')
-    flat_rg_len = len(flat_rg)
-    segmentPairAffinities = numpy.zeros(flat_rg_len, dtype='float32')
-    segmentPairs = numpy.zeros((flat_rg_len, 2), dtype='uint32')
-
-    for i in range(flat_rg_len):
-        t = rg[i]
-        segmentPairAffinities = t[0]
-        segmentPairs[i, 0] = t[1]
-        segmentPairs[i, 1] = t[2]
-
-    return segmentPairs, segmentPairAffinities
-    
+    """
+    Segment pairs (an (n, 2) array of id1, id2 rows) and their affinities (n weights) of a region graph. For a
+    RegionGraph these are its own `ids` and `weights` arrays, not copies
+    """
+    rg = as_regiongraph(rg)
+    return rg.ids, rg.weights
+
+def _save_columns(target, columns, name):
+    """
+    Save a dict of equal-length arrays, one dataset per column, to an .npz file or to group `name` (replaced if it
+    exists) of an HDF5 file: a path, or an open h5py File or Group such as the output file next to 'main'
+    """
+    if isinstance(target, str) and target.endswith('.npz'):
+        numpy.savez(target, **columns)
+        return
+    h5file = h5py.File(target, 'a') if isinstance(target, str) else target
+    try:
+        if name in h5file:
+            del h5file[name]
+        group = h5file.create_group(name)
+        for (column, data) in columns.items():
+            group.create_dataset(column, data=data)
+    finally:
+        if isinstance(target, str):
+            h5file.close()
+
+def _load_columns(source, columns, name):
+    """The named columns saved by _save_columns, as a dict of arrays"""
+    if isinstance(source, str) and source.endswith('.npz'):
+        with numpy.load(source) as saved:
+            return dict((column, saved[column]) for column in columns)
+    h5file = h5py.File(source, 'r') if isinstance(source, str) else source
+    try:
+        return dict((column, h5file[name][column][...]) for column in columns)
+    finally:
+        if isinstance(source, str):
+            h5file.close()
+
+def save_regiongraph(target, rg, name='regiongraph'):
+    """
+    Save a region graph as its `weights` and `ids` columns, to an .npz file or to group `name` of an HDF5 file (see
+    _save_columns). load_regiongraph reads it back as is
+    """
+    rg = as_regiongraph(rg)
+    _save_columns(target, {'weights': rg.weights, 'ids': rg.ids}, name)
+
+def load_regiongraph(source, name='regiongraph'):
+    """Region graph saved by save_regiongraph, from an .npz file or an HDF5 file (path, File or Group)"""
+    columns = _load_columns(source, ('weights', 'ids'), name)
+    return RegionGraph(columns['weights'], columns['ids'])
+
+def _empty_stats(n, shape):
+    """Statistics table with rows for IDs 0 to n-1 and no voxels counted yet"""
+    return {'count': numpy.zeros(n, dtype='int64'),
+            'bbox_min': numpy.tile(numpy.array(shape, dtype='int64'), (n, 1)),
+            'bbox_max': numpy.zeros((n, 3), dtype='int64'),
+            'centroid': numpy.zeros((n, 3), dtype='float64'), #Coordinate sums until the end of segmentstats
+            'max_affinity': numpy.full(n, -numpy.inf, dtype='float64')}
+
+def _grow_stats(stats, n, shape):
+    """stats with rows up to ID n-1"""
+    more = _empty_stats(n - len(stats['count']), shape)
+    return dict((name, numpy.concatenate((stats[name], more[name]))) for name in SEGMENT_STATS)
+
+def segmentstats(seg, aff=None, slab_bytes=DEFAULT_STATS_SLAB_BYTES):
+    """
+    Per-segment statistics of seg, an (x, y, z) array or HDF5 dataset, gathered in one pass over its z-slabs.
+    Returns a table of columns indexed by segment ID (row 0 is the background):
+        count         voxels of the segment
+        bbox_min      (x, y, z) of the first voxel of its bounding box
+        bbox_max      (x, y, z) one past the last voxel of its bounding box
+        centroid      mean (x, y, z) of its voxels
+        max_affinity  largest affinity between two of its voxels, in affinity units (NaN without aff, or for
+                      segments without two adjacent voxels)
+    IDs without voxels have count 0, a NaN centroid and an empty bounding box. `aff` is the matching (x, y, z, 3)
+    affinity array or dataset; it is read slab by slab alongside seg.
+    """
+    shape = tuple(seg.shape[:3])
+    stats = _empty_stats(1, shape)
+    for zs in _slabs(seg, slab_bytes):
+        first = max(zs.start - 1, 0) #One plane before the slab, for the z affinities into it
+        labels = numpy.asarray(seg[:, :, first:zs.stop])
+        if labels.size == 0:
+            continue
+        n = int(labels.max()) + 1
+        if n > len(stats['count']):
+            stats = _grow_stats(stats, n, shape)
+        n = len(stats['count'])
+        own = labels[:, :, zs.start-first:]
+        flat = own.ravel()
+        stats['count'] += numpy.bincount(flat, minlength=n)
+        for (axis, index) in enumerate(numpy.ogrid[:own.shape[0], :own.shape[1], zs]):
+            coords = numpy.broadcast_to(index, own.shape).ravel()
+            stats['centroid'][:, axis] += numpy.bincount(flat, weights=coords, minlength=n)
+            numpy.minimum.at(stats['bbox_min'][:, axis], flat, coords)
+            numpy.maximum.at(stats['bbox_max'][:, axis], flat, coords + 1)
+        if aff is None:
+            continue
+        affs = numpy.asarray(aff[:, :, zs, :])
+        start = max(zs.start, 1) - first #Planes of labels with a z neighbour before them
+        pairs = [(own[1:, :, :], own[:-1, :, :], affs[1:, :, :, 0]),
+                 (own[:, 1:, :], own[:, :-1, :], affs[:, 1:, :, 1]),
+                 (labels[:, :, start:], labels[:, :, start-1:-1], affs[:, :, start-(zs.start-first):, 2])]
+        for (here, there, weights) in pairs:
+            inside = (here == there) & (here != 0)
+            numpy.maximum.at(stats['max_affinity'], here[inside], weights[inside])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        stats['centroid'] /= stats['count'][:, numpy.newaxis]
+    scale = affinity_scale(aff.dtype) if aff is not None else 1.0
+    stats['max_affinity'] = numpy.where(numpy.isinf(stats['max_affinity']), numpy.nan,
+                                        stats['max_affinity'] * scale).astype('float32')
+    empty = stats['count'] == 0
+    stats['bbox_min'][empty] = 0
+    return stats
+
+def segment_slices(stats, segid):
+    """Bounding box of segment segid as a tuple of slices, to crop it out of the segmentation or the affinities"""
+    return tuple(slice(int(lo), int(hi)) for (lo, hi) in zip(stats['bbox_min'][segid], stats['bbox_max'][segid]))
+
+def largest_segments(stats, n=1):
+    """IDs of the n foreground segments with the most voxels, largest first"""
+    counts = stats['count'][1:]
+    n = min(n, len(counts))
+    if n == 0:
+        return numpy.zeros(0, dtype='int64')
+    largest = numpy.argpartition(-counts, n-1)[:n]
+    return largest[numpy.argsort(-counts[largest], kind='stable')] + 1
+
+def save_segmentstats(target, stats, name='segments'):
+    """Save a segmentstats table as one dataset per column, like save_regiongraph"""
+    _save_columns(target, dict((column, stats[column]) for column in SEGMENT_STATS), name)
+
+def load_segmentstats(source, name='segments'):
+    """segmentstats table saved by save_segmentstats, from an .npz file or an HDF5 file (path, File or Group)"""
+    return _load_columns(source, SEGMENT_STATS, name)
 
 if __name__ == '__main__':
     thresh = Thresholds()
-    
-    if len(sys.argv) > 2:
-        thresh.input_path = sys.argv[1]
-        output_path = sys.argv[2]
-        if len(sys.argv) == 8:
-            thresh.high_threshold = float(sys.argv[3])
-            thresh.low_threshold = float(sys.argv[4])
-            thresh.merge_threshold = float(sys.argv[5])
-            thresh.merge_size = int(sys.argv[6])
-            thresh.dust_size = int(sys.argv[7])
-            thresh.is_threshold_relative = False
-    else:
-        raise RuntimeError('Must pass in at least input and output file names')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_path', type=str,
+        help='HDF5 file with the affinities in its "main" dataset')
+    parser.add_argument('output_path', type=str,
+        help='HDF5 file to write the segmentation to')
+    parser.add_argument('absolute', nargs='*', default=[],
+        help='Optional absolute thresholds: high low merge_threshold merge_size dust_size')
+    parser.add_argument('--block', dest='block_shape', type=int, nargs=3, default=None,
+        help='Segment blockwise with blocks of this many voxels along x y z, to bound memory use')
+    parser.add_argument('--halo', dest='halo', type=int, default=DEFAULT_HALO,
+        help='Voxels of context around each block in blockwise mode')
+    parser.add_argument('--histogram_error', dest='histogram_error', type=float, default=DEFAULT_HISTOGRAM_ERROR,
+        help='Largest error of the absolute thresholds derived from relative ones')
+    parser.add_argument('--chunks', dest='chunks', type=int, nargs=3, default=None,
+        help='Chunk shape of the output dataset along x y z')
+    parser.add_argument('--compression', dest='compression', type=str, default=DEFAULT_COMPRESSION,
+        choices=['gzip', 'lzf', 'none'], help='Compression filter of the output dataset')
+    parser.add_argument('--compression_level', dest='compression_level', type=int, default=None,
+        help='gzip compression level, 0-9')
+    parser.add_argument('--affinity_dtype', dest='affinity_dtype', type=str, default=None,
+        choices=['float32', 'float16', 'uint8'], help='Convert the affinities to this dtype as they are read, uint8 quantizes them')
+    parser.add_argument('--low_memory', dest='low_memory', action='store_true',
+        help='Memory-map uncompressed, contiguous affinities instead of reading them into memory')
+    parser.add_argument('--backend', dest='backend', type=str, default=None, choices=BACKENDS,
+        help='Backend of the core kernels, by default the WATERSHED_BACKEND environment variable or numba if installed')
+    parser.add_argument('--cache_dir', dest='cache_dir', type=str, default=None,
+        help='Directory caching basins and region graphs, so that only merging reruns for new merge parameters')
+    parser.add_argument('--cache_size', dest='cache_size', type=float, default=DEFAULT_CACHE_BYTES / 2.0**30,
+        help='Size of the cache in GiB, least recently used entries are evicted beyond it')
+    parser.add_argument('--stage_log', dest='stage_log', type=str, default=None,
+        help='File to append one JSON line per pipeline stage to, with timings, peak memory and counts')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+        help='Threads building the region graph from z-slabs of the volume, by default one per CPU')
+    parser.add_argument('--no_stats', dest='statistics', action='store_false',
+        help='Do not store the per-segment statistics table (voxel counts, bounding boxes, centroids) in "segments"')
+    args = parser.parse_args()
+
+    thresh.input_path = args.input_path
+    output_path = args.output_path
+    if len(args.absolute) == 5:
+        thresh.high_threshold = float(args.absolute[0])
+        thresh.low_threshold = float(args.absolute[1])
+        thresh.merge_threshold = float(args.absolute[2])
+        thresh.merge_size = int(args.absolute[3])
+        thresh.dust_size = int(args.absolute[4])
+        thresh.is_threshold_relative = False
+    elif len(args.absolute) != 0:
+        parser.error('Pass all five of high low merge_threshold merge_size dust_size, or none of them')
+    thresh.block_shape = args.block_shape
+    thresh.halo = args.halo
+    thresh.histogram_error = args.histogram_error
+    thresh.chunks = args.chunks
+    thresh.compression = None if args.compression == 'none' else args.compression
+    thresh.compression_level = args.compression_level
+    thresh.affinity_dtype = args.affinity_dtype
+    thresh.low_memory = args.low_memory
+    thresh.cache_dir = args.cache_dir
+    thresh.cache_size = int(args.cache_size * 2**30)
+    thresh.statistics = args.statistics
+    thresh.workers = args.workers
+    if args.backend is not None:
+        set_backend(args.backend)
 
     print("==================================")
     print("Input path: " + thresh.input_path)
@@ -157,10 +641,32 @@ if __name__ == '__main__':
     print("Merge Threshold: " + str(thresh.merge_threshold))
     print("Merge Size: " + str(thresh.merge_size))
     print("Dust Size: " + str(thresh.dust_size))
+    if thresh.block_shape is not None:
+        print("Block Shape: " + str(thresh.block_shape) + ", Halo: " + str(thresh.halo))
     print("==================================")
 
-    seg = atomicseg(thresh)
+    with h5py.File(thresh.input_path, 'r') as h5file:
+        shape = h5file["main"].shape[:3]
     out_file = h5py.File(output_path, 'w')
-    out_file.create_dataset('main', data=seg)
+    stage_log = open(args.stage_log, 'a') if args.stage_log is not None else None
+    callback = json_lines(stage_log) if stage_log is not None else None
+    if thresh.block_shape is None:
+        seg = atomicseg(thresh, callback)
+        out_dataset = create_output(out_file, shape, thresh, seg.dtype) # uint64 if the IDs do not fit in uint32
+        with measure("write", seg.size, callback):
+            write_slabs(out_dataset, seg)
+    else:
+        out_dataset = create_output(out_file, shape, thresh) # blockseg raises OverflowError if its IDs outgrow it
+        seg = out_dataset
+        blockseg(thresh, out_dataset, callback)
+    if thresh.statistics:
+        print("Segment Statistics")
+        with h5py.File(thresh.input_path, 'r') as h5file, measure("segmentstats", numpy.prod(shape), callback) as record:
+            stats = segmentstats(seg, h5file["main"])
+            record.update(segments=int(numpy.count_nonzero(stats['count'][1:])))
+        save_segmentstats(out_file, stats)
+    del seg
     out_file.close()
+    if stage_log is not None:
+        stage_log.close()
     print("Output written to file")